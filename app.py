@@ -1,95 +1,414 @@
 import os
+import sys
+import re
 import json
-import io
+import time
+import atexit
+from contextlib import contextmanager
 import zipfile
-from waitress import serve
-from flask import Flask, render_template, send_from_directory, abort, send_file, request, redirect, url_for, flash
-from flask_sqlalchemy import SQLAlchemy
+import hashlib
+import threading
+import queue
+import itertools
+import base64
+import gzip
+import mimetypes
+from urllib.parse import quote
+import multiprocessing
+import signal
+import socket
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from waitress import serve, create_server
+from flask import Flask, Response, render_template, send_from_directory, abort, send_file, request, redirect, url_for, flash, jsonify, g, has_request_context
+from sqlalchemy import func, case, or_, event, select, literal, union_all, inspect as sql_inspect, text as sql_text, column as sql_column
+from sqlalchemy.engine import Engine
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
-from PIL import Image, ImageOps
-import cv2
+from werkzeug.security import safe_join
 from datetime import datetime
-
-# --- User config ---
-PUBLIC_DIRECTORY = 'PUBLIC'
-PRIVATE_DIRECTORY = 'PRIVATE'
-THUMBNAIL_SIZE = (300, 300)
-PAGE_TITLE = "Media explorer"
-PORT = 5000
-
+try: import brotli # optional, 'br' is only offered if it is installed
+except ImportError: brotli = None
+from config import (PRIVATE_DIRECTORY, THUMBNAIL_SIZE, THUMBNAIL_QUALITY, CACHE_DIRECTORY, THUMBNAIL_CACHE_LIMIT, RENDITION_SIZES,
+                    RENDITION_QUALITY, RENDITION_CACHE_LIMIT, PLACEHOLDER_SIZE, VIDEO_POSTER_SIZE, VIDEO_SPRITE_FRAMES,
+                    VIDEO_SPRITE_COLUMNS, VIDEO_SPRITE_TILE_WIDTH, PREVIEW_CACHE_LIMIT, THUMBNAIL_WORKERS, THUMBNAIL_QUEUE_SIZE,
+                    THUMBNAIL_WAIT_TIMEOUT, THUMBNAIL_RESCAN_INTERVAL, CATALOG_SCAN_INTERVAL, GALLERY_PAGE_SIZE, GALLERY_MAX_PAGE_SIZE,
+                    MAX_CONCURRENT_DOWNLOADS, ACCESS_CACHE_TTL, REVISION_CHECK_INTERVAL, LOG_FILE, LOG_FORMAT, LOG_FILE_MAX_BYTES,
+                    LOG_FILE_BACKUPS, LOG_RATE_LIMITS, MEDIA_MAX_AGE, STATIC_MAX_AGE, COMPRESS_MIN_SIZE, METRICS_ENABLED, PAGE_TITLE, PORT,
+                    METRICS_SHARE_INTERVAL, SERVER_PROCESSES, SERVER_THREADS, WORKER_SHUTDOWN_TIMEOUT, DATA_PATH, PUBLIC_PATH, PRIVATE_PATH,
+                    THUMBNAIL_CACHE_PATH, RENDITION_CACHE_PATH, PREVIEW_CACHE_PATH, CATALOG_LOCK_PATH, METRICS_PATH)
+from models import (db, init_app, User, FolderAccess, Group, UserGroup, GroupFolderAccess, MediaFolder, MediaItem, init_db,
+                    AUTH_REVISION, CATALOG_REVISION, get_revision, bump_revision)
+from media import (file_lock, is_media_file, is_compressed_file, is_video_file, has_renditions, read_image_info, make_placeholders, write_cache_file,
+                   generate_thumbnail, get_rendition_format, generate_rendition, generate_video_preview) # Pillow and OpenCV are loaded on first use
 
 # --- Initilation ---
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.urandom(24)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///photobook.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-db = SQLAlchemy(app)
+app = Flask(__name__, static_folder=None) # static files are served by serve_static
+app.config['SECRET_KEY'] = os.environ.get('MEDIA_EXPLORER_SECRET_KEY') or os.urandom(24) # shared by the server processes
+init_app(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message = "Please log in to access the media."
 login_manager.login_message_category = "info"
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-PUBLIC_PATH = os.path.join(BASE_DIR, PUBLIC_DIRECTORY)
-PRIVATE_PATH = os.path.join(BASE_DIR, PRIVATE_DIRECTORY)
-
 # --- Database ---
-class User(UserMixin, db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(100), unique=True, nullable=False)
-    password_hash = db.Column(db.String(200), nullable=False)
-    accesses = db.relationship('FolderAccess', backref='user', lazy=True, cascade="all, delete-orphan")
-    group = db.Column(db.String(100), unique=False, nullable=False)
-
-    def set_password(self, password): self.password_hash = generate_password_hash(password)
-    def set_group(self, group): self.group = group
-    def check_password(self, password): return check_password_hash(self.password_hash, password)
-
-class FolderAccess(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    folder_name = db.Column(db.String(255), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+# The models are in models.py, shared with manage_users.py. The search index is only used by the server.
+# Full text index of the catalog for /api/search: an SQLite FTS5 table over the name, path (so folder names match
+# too) and camera of the media items. Triggers keep it in sync with media_item, so every change made by
+# scan_catalog() is indexed in the same transaction; updates of other columns, e.g. the placeholders, skip the index.
+# Without FTS5 (or SQLite) search falls back to LIKE.
+SEARCH_INDEX_SQL = (
+    "CREATE VIRTUAL TABLE media_search USING fts5(name, path, camera, content='media_item', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER media_search_insert AFTER INSERT ON media_item BEGIN "
+    "INSERT INTO media_search(rowid, name, path, camera) VALUES (new.id, new.name, new.path, new.camera); END",
+    "CREATE TRIGGER media_search_delete AFTER DELETE ON media_item BEGIN "
+    "INSERT INTO media_search(media_search, rowid, name, path, camera) VALUES ('delete', old.id, old.name, old.path, old.camera); END",
+    "CREATE TRIGGER media_search_update AFTER UPDATE OF name, path, camera ON media_item BEGIN "
+    "INSERT INTO media_search(media_search, rowid, name, path, camera) VALUES ('delete', old.id, old.name, old.path, old.camera); "
+    "INSERT INTO media_search(rowid, name, path, camera) VALUES (new.id, new.name, new.path, new.camera); END",
+    "INSERT INTO media_search(media_search) VALUES ('rebuild')",
+)
+search_index = None # whether media_search exists, checked on first use
+
+def init_search_index() -> None:
+    """Create the search index after init_db() if it is missing or outdated. Needs an app context."""
+    global search_index
+    if db.engine.dialect.name != 'sqlite': return
+    with db.engine.connect() as connection: # an index created by an older version is built again
+        if connection.execute(sql_text("SELECT sql FROM sqlite_master WHERE name = 'media_search_update'")).scalar() == SEARCH_INDEX_SQL[3]: return
+    try:
+        with db.engine.begin() as connection:
+            for name in ('media_search_insert', 'media_search_delete', 'media_search_update'): connection.execute(sql_text(f"DROP TRIGGER IF EXISTS {name}"))
+            connection.execute(sql_text("DROP TABLE IF EXISTS media_search"))
+            for statement in SEARCH_INDEX_SQL: connection.execute(sql_text(statement))
+    except Exception as e: # SQLite built without FTS5
+        log(f"⚠️ Search index not available, searching without it: {e}", IP=False)
+    search_index = None
+
+def has_search_index() -> bool:
+    global search_index
+    if search_index is None: search_index = sql_inspect(db.engine).has_table('media_search')
+    return search_index
+
+# --- Login and access cache ---
+# load_user() runs on every request. Instead of a User row it returns a CachedUser with the access rights resolved
+# by one query, kept for ACCESS_CACHE_TTL seconds. Changes made by manage_users.py bump the 'auth' revision, which
+# clears the cache of every running server within REVISION_CHECK_INTERVAL seconds.
+class CachedUser(UserMixin):
+    def __init__(self, user_id, username, groups, folders):
+        self.id = user_id
+        self.username = username
+        self.groups = groups # in the user's order
+        self.folders = frozenset(folders) # private folders the user can see, granted directly or to a group
+        self.see_hidden = "!see_hidden" in groups
+        self.is_admin = "!admin" in groups
+
+def resolve_user(user_id):
+    """The CachedUser of a user id or None. The username, groups and direct and group folder grants come from one query."""
+    rows = db.session.execute(union_all(
+        select(literal('user'), User.username, literal(0)).where(User.id == user_id),
+        select(literal('group'), Group.name, UserGroup.position).join(UserGroup, UserGroup.group_id == Group.id).where(UserGroup.user_id == user_id),
+        select(literal('folder'), FolderAccess.folder_name, literal(0)).where(FolderAccess.user_id == user_id),
+        select(literal('folder'), GroupFolderAccess.folder_name, literal(0)).join(UserGroup, UserGroup.group_id == GroupFolderAccess.group_id).where(UserGroup.user_id == user_id),
+    )).all()
+    usernames = [name for kind, name, _ in rows if kind == 'user']
+    if not usernames: return None
+    groups = [name for kind, name, _ in sorted((row for row in rows if row[0] == 'group'), key=lambda row: row[2])]
+    return CachedUser(user_id, usernames[0], groups, [name for kind, name, _ in rows if kind == 'folder'])
+
+user_cache = {} # user id -> (expires at, CachedUser)
+auth_revision = None
+auth_revision_checked = 0
+
+def check_auth_revision() -> None:
+    global auth_revision, auth_revision_checked
+    now = datetime.now().timestamp()
+    if now - auth_revision_checked < REVISION_CHECK_INTERVAL: return
+    auth_revision_checked = now
+    revision = get_revision(AUTH_REVISION)
+    if revision != auth_revision:
+        user_cache.clear()
+        auth_revision = revision
 
 @login_manager.user_loader
-def load_user(user_id): return db.session.get(User, int(user_id))
+def load_user(user_id):
+    check_auth_revision()
+    user_id = int(user_id)
+    cached = user_cache.get(user_id)
+    if cached and cached[0] > datetime.now().timestamp(): return cached[1]
+    cached_user = resolve_user(user_id)
+    if cached_user is None: return None
+    user_cache[user_id] = (datetime.now().timestamp() + ACCESS_CACHE_TTL, cached_user)
+    return cached_user
 
 # --- Other functions ---
-def is_media_file(filename):
-    ext = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp4', '.mov', '.mkv'}
-    return os.path.splitext(filename)[1].lower() in ext
+def split_media_path(filepath) -> tuple[str, str]:
+    """Return the root directory and the path inside it for a path used in URLs."""
+    if filepath == PRIVATE_DIRECTORY or filepath.startswith(PRIVATE_DIRECTORY + '/'): return PRIVATE_PATH, filepath[len(PRIVATE_DIRECTORY)+1:]
+    return PUBLIC_PATH, filepath
+
+def get_full_path(filepath) -> str:
+    """The file system path of a path used in URLs. Aborts with 404 if it leaves its root directory, e.g. with '..'."""
+    full_path = safe_join(*split_media_path(filepath))
+    if full_path is None: abort(404)
+    return full_path
+
+# --- Media catalog ---
+catalog_lock = threading.Lock()
+catalog_scanned_at = 0 # 0 = not scanned by this process yet
+
+def join_media_path(parent_path, name) -> str:
+    return f"{parent_path}/{name}" if parent_path else name
+
+def scan_catalog() -> bool:
+    """
+    Bring the media catalog up to date with PUBLIC_PATH and PRIVATE_PATH. Needs an app context.
+
+    Every directory is stat'ed, but only directories whose mtime changed since the last scan are listed again,
+    so an unchanged tree costs one stat per folder. Only one process scans at a time. Returns True if anything in
+    the catalog changed.
+    """
+    global catalog_scanned_at
+    with catalog_lock, file_lock(CATALOG_LOCK_PATH), measure('catalog_scan'):
+        folders = {folder.path: folder for folder in MediaFolder.query.all()}
+        children = {}
+        for folder in folders.values(): children.setdefault(folder.parent_id, []).append(folder.name)
+        seen = set()
+        changed = scan_catalog_folder(folders, children, seen, PUBLIC_PATH, '', None)
+        changed |= scan_catalog_folder(folders, children, seen, PRIVATE_PATH, PRIVATE_DIRECTORY, None)
+
+        removed = [folder.id for path, folder in folders.items() if path not in seen]
+        if removed:
+            MediaItem.query.filter(MediaItem.folder_id.in_(removed)).delete(synchronize_session=False)
+            MediaFolder.query.filter(MediaFolder.id.in_(removed)).delete(synchronize_session=False)
+            changed = True
+        if changed:
+            update_catalog_counts()
+            bump_revision(CATALOG_REVISION, commit=False)
+        db.session.commit()
+        if changed or not catalog_scanned_at: start_placeholder_fill()
+        catalog_scanned_at = datetime.now().timestamp()
+        return changed
+
+def scan_catalog_folder(folders, children, seen, full_path, path, parent_id) -> bool:
+    try: mtime = os.stat(full_path).st_mtime
+    except OSError: return False
+    seen.add(path)
+    folder = folders.get(path)
+    if folder is None:
+        folder = MediaFolder(path=path, name=os.path.basename(path) if parent_id else path, parent_id=parent_id)
+        db.session.add(folder); db.session.flush()
+        folders[path] = folder
+    if folder.mtime == mtime:
+        changed = False
+        subfolders = children.get(folder.id, [])
+    else:
+        changed = True
+        subfolders, files = [], {}
+        try:
+            for entry in os.scandir(full_path):
+                if entry.is_dir(): subfolders.append(entry.name)
+                elif is_media_file(entry.name): files[entry.name] = entry
+        except OSError: return False
+        existing = {item.name: item for item in MediaItem.query.filter_by(folder_id=folder.id)}
+        for name, item in existing.items():
+            if name not in files: db.session.delete(item)
+        for name, entry in files.items():
+            try: stat = entry.stat()
+            except OSError: continue
+            item = existing.get(name)
+            if item is None:
+                item = MediaItem(folder_id=folder.id, name=name, path=join_media_path(path, name), type='video' if is_video_file(name) else 'image', is_hidden=name[0] == '.')
+                db.session.add(item)
+            elif item.mtime == stat.st_mtime and item.size == stat.st_size: continue
+            item.mtime, item.size = stat.st_mtime, stat.st_size
+            taken_at, item.camera, item.width, item.height = read_image_info(entry.path) if item.type == 'image' else (None, None, None, None)
+            item.date = taken_at or stat.st_mtime
+            item.placeholder = None
+        folder.mtime = mtime
+    for name in subfolders:
+        changed |= scan_catalog_folder(folders, children, seen, os.path.join(full_path, name), join_media_path(path, name), folder.id)
+    return changed
+
+def update_catalog_counts() -> None:
+    """Recompute the recursive media counts of all folders."""
+    db.session.flush()
+    folders = {folder.id: folder for folder in MediaFolder.query.all()}
+    counts = {folder_id: [0, 0] for folder_id in folders}
+    rows = db.session.query(MediaItem.folder_id, func.count(MediaItem.id), func.sum(case((MediaItem.is_hidden == False, 1), else_=0))).group_by(MediaItem.folder_id)
+    for folder_id, item_count, visible_count in rows:
+        while folder_id is not None: # add the counts to the folder and all its parents
+            counts[folder_id][0] += item_count; counts[folder_id][1] += visible_count
+            folder_id = folders[folder_id].parent_id
+    for folder_id, (item_count, visible_count) in counts.items():
+        folders[folder_id].item_count, folders[folder_id].visible_count = item_count, visible_count
+
+# Placeholders, tiny copies of the images and video frames inlined in the gallery API, which the grid shows until
+# the thumbnails arrive. Making them means decoding the files, so instead of slowing down the scan they are filled
+# in afterwards by a background thread, in batches run by the ThumbnailPool workers when they are running. Only
+# processes that serve requests fill them (see start_background_work), not the supervisor of the server processes.
+PLACEHOLDER_BATCH = 50
+PLACEHOLDER_REVISION_INTERVAL = 30 # seconds, clients see new placeholders with the next catalog revision
+PLACEHOLDER_LOCK_PATH = os.path.join(DATA_PATH, CACHE_DIRECTORY, 'placeholders.lock')
+placeholder_fill_enabled = False
+placeholder_thread = None
 
-def is_video_file(filename):
-    ext = {'.mp4', '.mov', '.mkv', '.webm'}
-    return os.path.splitext(filename)[1].lower() in ext
+def start_placeholder_fill() -> None:
+    global placeholder_thread
+    if not placeholder_fill_enabled or PLACEHOLDER_SIZE <= 0 or (placeholder_thread is not None and placeholder_thread.is_alive()): return
+    placeholder_thread = threading.Thread(target=fill_placeholders, name='placeholders', daemon=True)
+    placeholder_thread.start()
+
+def fill_placeholders() -> None:
+    """Make the missing placeholders (and video dimensions). Only one process does it at a time."""
+    with file_lock(PLACEHOLDER_LOCK_PATH, blocking=False) as locked, app.app_context():
+        if not locked: return
+        bumped_at, unpublished = time.monotonic(), False
+        while items := MediaItem.query.filter(MediaItem.placeholder.is_(None)).limit(PLACEHOLDER_BATCH).all():
+            jobs = [(os.path.join(*split_media_path(item.path)), item.type) for item in items]
+            try: results = thumbnail_pool.executor.submit(make_placeholders, jobs).result() if thumbnail_pool.running else make_placeholders(jobs)
+            except Exception: break # pool shut down or broken, the next scan starts over
+            with catalog_lock, file_lock(CATALOG_LOCK_PATH):
+                for item, (width, height, placeholder) in zip(items, results):
+                    values = {MediaItem.placeholder: placeholder, **({MediaItem.width: width, MediaItem.height: height} if width else {})}
+                    # matches nothing if a scan changed or removed the item meanwhile
+                    MediaItem.query.filter_by(id=item.id, mtime=item.mtime).update(values, synchronize_session=False)
+                unpublished = time.monotonic() - bumped_at < PLACEHOLDER_REVISION_INTERVAL
+                if unpublished: db.session.commit()
+                else: bump_revision(CATALOG_REVISION); bumped_at = time.monotonic()
+        if unpublished:
+            with catalog_lock, file_lock(CATALOG_LOCK_PATH): bump_revision(CATALOG_REVISION)
+
+def refresh_catalog() -> None:
+    """Scan right away if this process has never scanned, otherwise refresh a stale catalog in the background."""
+    if not catalog_scanned_at: scan_catalog(); return
+    if datetime.now().timestamp() - catalog_scanned_at < CATALOG_SCAN_INTERVAL or catalog_lock.locked(): return
+    def background_scan():
+        with app.app_context(): scan_catalog()
+    threading.Thread(target=background_scan, name='catalog-scan', daemon=True).start()
+
+def get_visible_folders_filter(user_accesses):
+    """SQL filter for the folders of PUBLIC and of the private folders the user has access to."""
+    conditions = [~MediaFolder.path.startswith(f"{PRIVATE_DIRECTORY}/", autoescape=True) & (MediaFolder.path != PRIVATE_DIRECTORY)]
+    for folder_name in user_accesses:
+        private_path = join_media_path(PRIVATE_DIRECTORY, folder_name)
+        conditions.append((MediaFolder.path == private_path) | MediaFolder.path.startswith(f"{private_path}/", autoescape=True))
+    return or_(*conditions)
+
+def get_catalog_structure(user_accesses, see_hidden) -> list:
+    """Build the nested folder structure served by /api/gallery-data from the catalog."""
+    count_column = MediaFolder.item_count if see_hidden else MediaFolder.visible_count
+    folders = {folder.id: folder for folder in MediaFolder.query.filter(get_visible_folders_filter(user_accesses), count_column > 0)}
+    items = MediaItem.query.filter(MediaItem.folder_id.in_(folders.keys()))
+    if not see_hidden: items = items.filter(MediaItem.is_hidden == False)
+
+    nodes = {folder_id: {'name': folder.name, 'type': 'folder', 'path': folder.path, 'children': []} for folder_id, folder in folders.items()}
+    for folder_id, folder in folders.items():
+        if folder.parent_id in nodes: nodes[folder.parent_id]['children'].append(nodes[folder_id])
+    for item in items: nodes[item.folder_id]['children'].append(item_to_json(item))
+    for node in nodes.values(): node['children'].sort(key=lambda child: child['name'])
 
-def get_folder_structure(root_path, current_path, is_private=False):
     structure = []
-    base_folder_for_relative_path = PRIVATE_PATH if is_private else PUBLIC_PATH
-    try:
-        for item in sorted(os.listdir(current_path)):
-            full_item_path = os.path.join(current_path, item)
-            relative_path_prefix = PRIVATE_DIRECTORY if is_private else ''
-            relative_item_path = os.path.join(relative_path_prefix, os.path.relpath(full_item_path, base_folder_for_relative_path))
-            
-            if os.path.isdir(full_item_path):
-                sub_folder_data = {'name': item, 'type': 'folder', 'path': relative_item_path, 'children': get_folder_structure(base_folder_for_relative_path, full_item_path, is_private)}
-                if sub_folder_data['children']: structure.append(sub_folder_data)
-            elif is_media_file(item) and (item[0] != '.' or "!see_hidden" in current_user.group.split(",")):
-                mtime = os.path.getmtime(full_item_path)
-                structure.append({'name': item, 'type': 'video' if is_video_file(item) else 'image', 'path': relative_item_path.replace('\\', '/'), 'metadata': {'created': datetime.fromtimestamp(mtime).strftime('%d. %m. %Y %H:%M')}})
-    except FileNotFoundError: return []
+    by_path = {folder.path: nodes[folder_id] for folder_id, folder in folders.items()}
+    if '' in by_path: structure.extend(by_path['']['children']) # files and folders directly in PUBLIC
+    for folder_name in sorted(user_accesses):
+        private_folder = by_path.get(join_media_path(PRIVATE_DIRECTORY, folder_name))
+        if private_folder: structure.append(private_folder)
     return structure
 
-    
+def item_to_json(item) -> dict:
+    data = {'name': item.name, 'type': item.type, 'path': item.path, 'metadata': {'created': datetime.fromtimestamp(item.mtime).strftime('%d. %m. %Y %H:%M')},
+            'width': item.width, 'height': item.height, 'orientation': get_orientation(item.width, item.height), 'placeholder': item.placeholder or None}
+    renditions = get_rendition_urls(item) if has_renditions(item.name) else None
+    if renditions:
+        data['renditions'] = renditions
+        data['srcset'] = ', '.join(f"{rendition['url']} {rendition['size']}w" for rendition in data['renditions'])
+    elif item.type == 'video':
+        data['poster'] = f"/video/poster/{quote(item.path)}"
+        data['preview'] = f"/video/manifest/{quote(item.path)}"
+    return data
+
+def get_orientation(width, height):
+    if not width or not height: return None
+    return 'landscape' if width > height else 'portrait' if height > width else 'square'
+
+def folder_to_json(folder, see_hidden) -> dict:
+    return {'name': folder.name, 'type': 'folder', 'path': folder.path, 'count': folder.item_count if see_hidden else folder.visible_count}
+
+def encode_cursor(values) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Return the [sort value, item id] stored in a cursor, None if it is malformed."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return values if isinstance(values, list) and len(values) == 2 and isinstance(values[0], (str, int, float)) and isinstance(values[1], int) else None
+    except (ValueError, UnicodeError): return None
+
+def get_subfolders(folder, user_accesses, see_hidden) -> list:
+    """Non-empty subfolders of a folder. The PUBLIC root also lists the private folders the user has access to."""
+    count_column = MediaFolder.item_count if see_hidden else MediaFolder.visible_count
+    subfolders = MediaFolder.query.filter(MediaFolder.parent_id == folder.id, count_column > 0).order_by(MediaFolder.name).all()
+    if folder.path == '' and user_accesses:
+        private_paths = [join_media_path(PRIVATE_DIRECTORY, folder_name) for folder_name in user_accesses]
+        subfolders += MediaFolder.query.filter(MediaFolder.path.in_(private_paths), count_column > 0).order_by(MediaFolder.name).all()
+    return subfolders
+
+def query_folder_items(folder, see_hidden, sort, descending, limit, cursor) -> list:
+    """
+    Up to limit + 1 media items of a folder, ordered by name or date, following the cursor. Pagination uses keyset
+    cursors (the sort value and id of the last item), so every page is a single indexed range query however deep
+    the user scrolls. The extra item tells whether there is a next page.
+    """
+    items = MediaItem.query.filter(MediaItem.folder_id == folder.id)
+    if not see_hidden: items = items.filter(MediaItem.is_hidden == False)
+    return get_item_page(items, MediaItem.name if sort == 'name' else MediaItem.date, descending, limit, cursor)
+
+def get_item_page(items, sort_column, descending, limit, cursor) -> list:
+    """Up to limit + 1 items of a MediaItem query after the keyset cursor [sort value, id]."""
+    if cursor:
+        value, item_id = cursor
+        if descending: items = items.filter(or_(sort_column < value, (sort_column == value) & (MediaItem.id < item_id)))
+        else: items = items.filter(or_(sort_column > value, (sort_column == value) & (MediaItem.id > item_id)))
+    order = (sort_column.desc(), MediaItem.id.desc()) if descending else (sort_column, MediaItem.id)
+    return items.order_by(*order).limit(limit + 1).all()
+
+def get_folder_page(folder, user_accesses, see_hidden, sort, descending, limit, cursor) -> dict:
+    """One page of the media in a folder. The subfolders are only part of the first page."""
+    page = query_folder_items(folder, see_hidden, sort, descending, limit, cursor)
+    last = page[limit - 1] if len(page) > limit else None
+    result = {'folder': folder_to_json(folder, see_hidden), 'items': [item_to_json(item) for item in page[:limit]],
+              'next_cursor': encode_cursor([last.name if sort == 'name' else last.date, last.id]) if last else None}
+    if not cursor: result['folders'] = [folder_to_json(subfolder, see_hidden) for subfolder in get_subfolders(folder, user_accesses, see_hidden)]
+    return result
+
+def search_media(user_accesses, see_hidden, query, media_type, date_from, date_to, sort, descending, limit, cursor) -> dict:
+    """
+    One page of the media matching a search in the folders the user can see. Every word of the query has to match
+    the start of a word in the name, the folder path or the camera. Dates are timestamps, compared with MediaItem.date.
+    """
+    items = MediaItem.query.join(MediaFolder, MediaItem.folder_id == MediaFolder.id).filter(get_visible_folders_filter(user_accesses))
+    if not see_hidden: items = items.filter(MediaItem.is_hidden == False)
+    words = re.findall(r'\w+', query)
+    if words and has_search_index():
+        match = ' '.join(f'"{word}"*' for word in words)
+        items = items.filter(MediaItem.id.in_(sql_text("SELECT rowid FROM media_search WHERE media_search MATCH :match").bindparams(match=match).columns(sql_column('rowid'))))
+    else:
+        for word in words: items = items.filter(or_(MediaItem.path.contains(word, autoescape=True), MediaItem.camera.contains(word, autoescape=True)))
+    if media_type: items = items.filter(MediaItem.type == media_type)
+    if date_from is not None: items = items.filter(MediaItem.date >= date_from)
+    if date_to is not None: items = items.filter(MediaItem.date < date_to)
+
+    sort_column = MediaItem.name if sort == 'name' else MediaItem.date
+    page = get_item_page(items, sort_column, descending, limit, cursor)
+    last = page[limit - 1] if len(page) > limit else None
+    return {'items': [dict(item_to_json(item), folder=item.path.rpartition('/')[0]) for item in page[:limit]],
+            'next_cursor': encode_cursor([last.name if sort == 'name' else last.date, last.id]) if last else None}
+
 def get_bg_name() -> str:
-    bg_name = current_user.group.split(",")[0]+'.png'
-    bg_abs_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", bg_name)
+    bg_name = (current_user.groups[0] if current_user.groups else '')+'.png'
+    bg_abs_path = os.path.join(STATIC_PATH, bg_name)
     return bg_name if os.path.isfile(bg_abs_path) else ''
 
-def get_timestamp() -> str:
-    return datetime.now().strftime("%m/%d/%y %H:%M:%S")
 def get_client_ip() -> str:
     ip_forwarded = (
     request.headers.get('X-Forwarded-For') or
@@ -101,10 +420,632 @@ def get_client_ip() -> str:
     else:
         ip = request.remote_addr
     return ip
-def log(log_text, IP=True) -> None:
-    log_date = f"[{get_timestamp()}]"
-    log_ip = get_client_ip() if IP else "server"
-    print(f"{log_date} {f'({log_ip})': <18}:", log_text)
+
+# --- Logging ---
+# log() only builds a record and puts it in a queue, a writer thread formats the records and writes them in batches,
+# so request threads never wait for a slow console, pipe or disk. Events listed in LOG_RATE_LIMITS are sampled.
+log_queue = queue.Queue(maxsize=10000)
+log_lock = threading.Lock()
+log_writer = None
+log_counters = {} # event -> [start of the current second, lines written in it, lines suppressed]
+log_dropped = 0 # records lost because the queue was full
+
+def log(log_text, IP=True, event=None) -> None:
+    global log_dropped
+    if event in LOG_RATE_LIMITS and not allow_log_event(event): return
+    record = (time.time(), get_client_ip() if IP else "server", event, log_text)
+    try: log_queue.put_nowait(record)
+    except queue.Full: log_dropped += 1
+    if log_writer is None: start_log_writer()
+
+def allow_log_event(event) -> bool:
+    now = int(time.time())
+    with log_lock:
+        counter = log_counters.setdefault(event, [now, 0, 0])
+        if counter[0] != now: counter[0], counter[1] = now, 0
+        if counter[1] < LOG_RATE_LIMITS[event]:
+            counter[1] += 1
+            return True
+        counter[2] += 1
+        return False
+
+def format_log_record(record) -> str:
+    timestamp, ip, event, text = record
+    if LOG_FORMAT == 'json':
+        return json.dumps({'time': datetime.fromtimestamp(timestamp).isoformat(timespec='milliseconds'), 'ip': ip, 'event': event, 'message': text.strip()}, ensure_ascii=False) + "\n"
+    return f"[{datetime.fromtimestamp(timestamp).strftime('%m/%d/%y %H:%M:%S')}] {f'({ip})': <18}: {text}\n"
+
+class LogWriter:
+    """
+    Writes batches of log lines to stdout or to LOG_FILE, rotating the file above LOG_FILE_MAX_BYTES. Server
+    processes share LOG_FILE: writes are locked and a file rotated by another process is reopened.
+    """
+    def __init__(self):
+        self.file = None
+
+    def write(self, text) -> None:
+        if LOG_FILE is None:
+            sys.stdout.write(text); sys.stdout.flush()
+            return
+        with file_lock(f"{os.path.abspath(LOG_FILE)}.lock"):
+            if self.file is not None and self.is_rotated(): self.file.close(); self.file = None
+            if self.file is None: self.file = open(LOG_FILE, 'a', encoding='utf-8')
+            self.file.write(text); self.file.flush()
+            if self.file.tell() >= LOG_FILE_MAX_BYTES: self.rotate()
+
+    def is_rotated(self) -> bool:
+        try: return os.stat(LOG_FILE).st_ino != os.fstat(self.file.fileno()).st_ino
+        except OSError: return True
+
+    def rotate(self) -> None:
+        self.file.close(); self.file = None
+        for i in range(LOG_FILE_BACKUPS - 1, 0, -1):
+            if os.path.exists(f"{LOG_FILE}.{i}"): os.replace(f"{LOG_FILE}.{i}", f"{LOG_FILE}.{i + 1}")
+        os.replace(LOG_FILE, f"{LOG_FILE}.1")
+
+def write_logs(writer) -> None:
+    global log_dropped
+    while True:
+        try: records = [log_queue.get(timeout=1)]
+        except queue.Empty: records = []
+        while len(records) < 500:
+            try: records.append(log_queue.get_nowait())
+            except queue.Empty: break
+        taken = len(records)
+        with log_lock:
+            for name, counter in log_counters.items():
+                if counter[2] and counter[0] < int(time.time()): # report what the last full second suppressed
+                    records.append((time.time(), "server", None, f"⏩ {counter[2]} {name} log lines suppressed"))
+                    counter[2] = 0
+        if log_dropped:
+            records.append((time.time(), "server", None, f"⚠️ {log_dropped} log lines dropped, the log queue was full"))
+            log_dropped = 0
+        if records:
+            try: writer.write(''.join(format_log_record(record) for record in records))
+            except Exception: pass # logging must never take the server down
+        for _ in range(taken): log_queue.task_done()
+
+def start_log_writer() -> None:
+    global log_writer
+    with log_lock:
+        if log_writer is not None: return
+        log_writer = threading.Thread(target=write_logs, args=(LogWriter(),), name='log-writer', daemon=True)
+        log_writer.start()
+
+@atexit.register
+def flush_logs() -> None:
+    """Give the writer thread a moment to write what is still queued."""
+    deadline = time.time() + 2
+    while log_writer is not None and log_queue.unfinished_tasks and time.time() < deadline: time.sleep(0.05)
+
+# --- Metrics ---
+# Latency histograms and counters per route and per internal stage in the Prometheus text format. With
+# METRICS_ENABLED off, measure() and the request hooks return right away. Rendering stages run in the worker
+# processes, which time them with a media.StageTimer and send the durations back with their result.
+# With SERVER_PROCESSES > 1 each server process writes a snapshot of its series to METRICS_PATH every
+# METRICS_SHARE_INTERVAL seconds, and /metrics shows those of all processes with a 'process' label, whichever
+# process answers.
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {} # name -> (buckets, {labels: [count per bucket..., sum, count]})
+        self.counters = {} # name -> {labels: value}
+        self.help = {}
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, (buckets, {}))[1].setdefault(key, [0] * (len(buckets) + 2))
+            for i, bound in enumerate(buckets):
+                if value <= bound: series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def increment(self, name, value=1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def snapshot(self) -> dict:
+        """The series as JSON data, see share_metrics()."""
+        with self.lock:
+            return {'counters': {name: list(series.items()) for name, series in self.counters.items()},
+                    'histograms': {name: [buckets, list(series.items())] for name, (buckets, series) in self.histograms.items()}}
+
+    def render(self, process=None, shared=None) -> str:
+        """
+        The series in the Prometheus text format. With several server processes, process is the label of this one
+        and shared the snapshots of the others by their label.
+        """
+        def format_labels(labels, extra=()):
+            pairs = [f'{name}="{escape_label(value)}"' for name, value in (*labels, *extra)]
+            return '{' + ','.join(pairs) + '}' if pairs else ''
+        counters, histograms = {}, {}
+        for label, snapshot in {process: self.snapshot(), **(shared or {})}.items():
+            extra = (('process', label),) if label is not None else ()
+            for name, series in snapshot['counters'].items():
+                for labels, value in series: counters.setdefault(name, {})[tuple(map(tuple, labels)) + extra] = value
+            for name, (buckets, series) in snapshot['histograms'].items():
+                for labels, values in series: histograms.setdefault(name, (buckets, {}))[1][tuple(map(tuple, labels)) + extra] = values
+        lines = []
+        for name, series in sorted(counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{format_labels(labels)} {value}" for labels, value in sorted(series.items()))
+        for name, (buckets, series) in sorted(histograms.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for labels, values in sorted(series.items()):
+                for bound, count in zip(buckets, values):
+                    lines.append(f"{name}_bucket{format_labels(labels, (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{format_labels(labels, (('le', '+Inf'),))} {values[-1]}")
+                lines.append(f"{name}_sum{format_labels(labels)} {values[-2]}")
+                lines.append(f"{name}_count{format_labels(labels)} {values[-1]}")
+        return '\n'.join(lines) + '\n'
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = Metrics()
+server_index = None # of this server process with SERVER_PROCESSES > 1
+
+def get_metrics_share_path(index) -> str:
+    return os.path.join(METRICS_PATH, f"{index}.json")
+
+def share_metrics(worker) -> None:
+    """Write the metrics of a server process until it stops, for /metrics in the other processes."""
+    while not worker.stopping:
+        try: write_cache_file(get_metrics_share_path(worker.index), json.dumps(metrics.snapshot()).encode('utf-8'))
+        except OSError as e: log(f"⚠️ Could not write metrics: {e}", IP=False)
+        time.sleep(METRICS_SHARE_INTERVAL)
+
+def read_shared_metrics() -> dict[str, dict]:
+    """Metric snapshots of the other server processes by index. Files not written recently are of stopped processes."""
+    snapshots = {}
+    for index in range(SERVER_PROCESSES):
+        if index == server_index: continue
+        path = get_metrics_share_path(index)
+        try:
+            if time.time() - os.path.getmtime(path) > 3 * METRICS_SHARE_INTERVAL: continue
+            with open(path, encoding='utf-8') as f: snapshots[str(index)] = json.load(f)
+        except (OSError, ValueError): continue
+    return snapshots
+
+def record_stages(stages) -> None:
+    if not METRICS_ENABLED: return
+    for stage, seconds in stages.items(): metrics.observe('media_explorer_stage_seconds', seconds, stage=stage)
+
+@contextmanager
+def measure(stage):
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try: yield
+    finally: metrics.observe('media_explorer_stage_seconds', time.perf_counter() - start, stage=stage)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(*args) -> None:
+    if METRICS_ENABLED and has_request_context() and 'db_queries' in g: g.db_queries += 1
+
+@app.before_request
+def start_request_metrics():
+    if not METRICS_ENABLED: return
+    g.request_start = time.perf_counter()
+    g.db_queries = 0
+
+@app.after_request
+def record_request_metrics(response):
+    if not METRICS_ENABLED or 'request_start' not in g: return response
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe('media_explorer_request_seconds', time.perf_counter() - g.request_start, route=route, method=request.method, status=response.status_code)
+    metrics.observe('media_explorer_db_queries_per_request', g.db_queries, buckets=COUNT_BUCKETS, route=route)
+    return response
+
+# --- HTTP caching ---
+# Catalog responses get a weak ETag from the catalog revision, the user's access rights and the URL, so a repeated
+# request is answered with 304 before the payload is built. JSON and HTML responses are compressed on the fly;
+# static files are compressed once and served with a version (a hash of their content) in the URL, so browsers can
+# keep them for STATIC_MAX_AGE without asking again. Stylesheets get the version added to their url() references
+# of static files, e.g. the background image. Media routes only allow private (browser) caching.
+STATIC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+COMPRESSED_MIMETYPES = {'application/json', 'text/html', 'text/css', 'text/javascript', 'application/javascript', 'image/svg+xml', 'image/vnd.microsoft.icon'}
+CONTENT_ENCODINGS = ['br', 'gzip'] if brotli else ['gzip'] # in order of preference
+APP_VERSION = str(os.stat(__file__).st_mtime_ns) # part of the catalog ETags, so a new version of the app invalidates them
+
+def compress(data, encoding, best=False) -> bytes:
+    if encoding == 'br': return brotli.compress(data, quality=11 if best else 5)
+    return gzip.compress(data, compresslevel=9 if best else 6, mtime=0)
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSED_MIMETYPES): return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(CONTENT_ENCODINGS)
+    if encoding is None or response.content_length is None or response.content_length < COMPRESS_MIN_SIZE: return response
+    response.set_data(compress(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def get_catalog_etag() -> str:
+    parts = [APP_VERSION, get_revision(CATALOG_REVISION), current_user.id, ','.join(sorted(current_user.folders)), current_user.see_hidden, request.full_path]
+    return hashlib.sha1('|'.join(map(str, parts)).encode('utf-8')).hexdigest()
+
+def catalog_response(build) -> Response:
+    """JSON response of build() with a weak ETag, or 304 without calling build() if the client has it already."""
+    etag = get_catalog_etag()
+    if request.if_none_match.contains_weak(etag): response = Response(status=304)
+    else: response = jsonify(build())
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def private_cache(response, max_age=MEDIA_MAX_AGE):
+    """Let the user's browser, but no shared cache, reuse a response of a logged in user for max_age seconds."""
+    response.cache_control.public = False
+    response.cache_control.no_cache = None
+    response.cache_control.private = True
+    response.cache_control.max_age = max_age
+    response.expires = None
+    return response
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'"()?#:]+)\1\s*\)""") # relative URLs without a query
+
+class StaticAsset:
+    """
+    A file of the static folder with its version and, for compressible types, its compressed variants. Stylesheets
+    are kept in memory with versioned url() references (data), the versions they used are in references.
+    """
+    def __init__(self, path, stat):
+        self.path = path
+        self.mtime_ns = stat.st_mtime_ns
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        with open(path, 'rb') as f: data = f.read()
+        self.data = None
+        self.references = {} # filename -> version
+        if self.mimetype == 'text/css': data = self.data = CSS_URL.sub(self.add_version, data.decode('utf-8')).encode('utf-8')
+        self.version = hashlib.sha1(data).hexdigest()[:12]
+        self.encoded = {}
+        if self.mimetype in COMPRESSED_MIMETYPES:
+            for encoding in CONTENT_ENCODINGS:
+                encoded = compress(data, encoding, best=True)
+                if len(encoded) < len(data): self.encoded[encoding] = encoded
+
+    def add_version(self, match) -> str:
+        quote_char, url = match.groups()
+        filename = os.path.relpath(os.path.join(os.path.dirname(self.path), url), STATIC_PATH).replace(os.sep, '/')
+        asset = get_static_asset(filename)
+        if asset is None: return match.group(0)
+        self.references[filename] = asset.version
+        return f"url({quote_char}{url}?v={asset.version}{quote_char})"
+
+    def is_stale(self, stat) -> bool:
+        """Whether the file or a file it references changed."""
+        if self.mtime_ns != stat.st_mtime_ns: return True
+        return any(getattr(get_static_asset(filename), 'version', None) != version for filename, version in self.references.items())
+
+static_assets = {} # filename -> StaticAsset
+
+def get_static_asset(filename):
+    """The StaticAsset of a file in the static folder (reloaded if the file changed) or None."""
+    path = safe_join(STATIC_PATH, filename)
+    if path is None: return None
+    try: stat = os.stat(path)
+    except OSError: return None
+    asset = static_assets.get(filename)
+    if asset is None or asset.is_stale(stat):
+        asset = static_assets[filename] = StaticAsset(path, stat)
+    return asset
+
+def load_static_assets() -> None:
+    """Hash and precompress the static files at startup instead of on their first request."""
+    for entry in os.scandir(STATIC_PATH):
+        if entry.is_file(): get_static_asset(entry.name)
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    if endpoint != 'static' or 'filename' not in values: return
+    asset = get_static_asset(values['filename'])
+    if asset: values['v'] = asset.version
+
+# --- Derived file cache ---
+# Thumbnails and renditions are stored as files under CACHE_DIRECTORY. The key covers the source path, its mtime and
+# size and the output settings, so a changed source file (or changed settings) simply maps to a new entry and the
+# stale one ages out through the LRU eviction. Cache file mtimes are used as the "last used" timestamp.
+# Entries are created under a file lock of their subfolder (see media.entry_lock), so concurrent server processes
+# never render the same entry twice. Each process only counts what it wrote itself, so with SERVER_PROCESSES > 1 the
+# size is recounted from disk every RECOUNT_INTERVAL seconds and eviction runs under a lock shared by all of them.
+class FileCache:
+    TOUCH_INTERVAL = 3600 # seconds, avoids rewriting the mtime of hot entries on every hit
+    RECOUNT_INTERVAL = 300 # seconds
+
+    def __init__(self, path, limit):
+        self.path = path
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.total_bytes = None # computed on first use
+        self.counted_at = 0
+
+    def get_path(self, key, extension) -> str:
+        return os.path.join(self.path, key[:2], f"{key}.{extension}")
+
+    def lookup(self, cache_path) -> bool:
+        """Return True if the entry exists and mark it as recently used."""
+        try: mtime = os.path.getmtime(cache_path)
+        except OSError: return False
+        if mtime < datetime.now().timestamp() - self.TOUCH_INTERVAL:
+            try: os.utime(cache_path)
+            except OSError: pass
+        return True
+
+    def account(self, added_bytes) -> None:
+        with self.lock:
+            now = datetime.now().timestamp()
+            if self.total_bytes is None or (SERVER_PROCESSES > 1 and now - self.counted_at > self.RECOUNT_INTERVAL):
+                self.total_bytes = sum(entry[2] for entry in self.list_entries())
+                self.counted_at = now
+            else:
+                self.total_bytes += added_bytes
+            if self.total_bytes > self.limit:
+                with file_lock(os.path.join(self.path, 'evict.lock')): self.evict()
+
+    def list_entries(self) -> list[tuple[float, str, int]]:
+        """Return (last used, path, size) for every cached file."""
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for file in files:
+                if file.endswith(('.tmp', '.lock')): continue
+                try:
+                    stat = os.stat(os.path.join(root, file))
+                    entries.append((stat.st_mtime, os.path.join(root, file), stat.st_size))
+                except OSError: continue
+        return entries
+
+    def evict(self) -> None:
+        """Delete least recently used files until the cache is at 90 % of its limit. Call with the lock held."""
+        entries = sorted(self.list_entries())
+        self.total_bytes = sum(entry[2] for entry in entries)
+        for _, path, size in entries:
+            if self.total_bytes <= self.limit * 0.9: break
+            try: os.remove(path)
+            except OSError: continue
+            self.total_bytes -= size
+
+thumbnail_cache = FileCache(THUMBNAIL_CACHE_PATH, THUMBNAIL_CACHE_LIMIT)
+rendition_cache = FileCache(RENDITION_CACHE_PATH, RENDITION_CACHE_LIMIT)
+preview_cache = FileCache(PREVIEW_CACHE_PATH, PREVIEW_CACHE_LIMIT)
+
+def get_cache_key(full_path, stat, variant) -> str:
+    raw = f"{full_path}|{stat.st_mtime_ns}|{stat.st_size}|{variant}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+# Thumbnails
+def get_thumbnail_key(full_path, stat) -> str:
+    return get_cache_key(full_path, stat, f"thumbnail|{THUMBNAIL_SIZE[0]}x{THUMBNAIL_SIZE[1]}|{THUMBNAIL_QUALITY}")
+
+def get_thumbnail_cache_path(key) -> str:
+    return thumbnail_cache.get_path(key, 'jpg')
+
+# Renditions, smaller copies of images for viewing them in the browser
+def get_rendition_key(full_path, stat, size) -> str:
+    return get_cache_key(full_path, stat, f"rendition|{size}|{get_rendition_format()}|{RENDITION_QUALITY}")
+
+def get_rendition_urls(item) -> list[dict]:
+    """Renditions smaller than the original, all of them if its size is not known yet."""
+    long_edge = max(item.width or 0, item.height or 0)
+    return [{'size': size, 'url': f"/rendition/{size}/{quote(item.path)}"} for size in RENDITION_SIZES if not long_edge or size < long_edge]
+
+# Video previews, a poster frame and a sprite sheet of frames at fixed intervals with a manifest for scrubbing,
+# rendered by media.generate_video_preview().
+def get_video_preview_key(full_path, stat) -> str:
+    return get_cache_key(full_path, stat, f"video-preview|{VIDEO_POSTER_SIZE}|{VIDEO_SPRITE_FRAMES}|{VIDEO_SPRITE_COLUMNS}|{VIDEO_SPRITE_TILE_WIDTH}")
+
+def get_video_preview_paths(key) -> tuple[str, str, str]:
+    """Poster, sprite sheet and manifest of a video preview. The manifest is written last and marks a complete preview."""
+    return preview_cache.get_path(key, 'poster.jpg'), preview_cache.get_path(key, 'sprite.jpg'), preview_cache.get_path(key, 'json')
+
+# --- Thumbnail pre-generation ---
+class ThumbnailPool:
+    """
+    Generates thumbnails in worker processes, so decoding does not block request threads or hold their GIL.
+
+    Jobs wait in a bounded priority queue: thumbnails a request is waiting for skip the queue entirely, folders
+    somebody is browsing come next and the background walk of all media folders comes last. The walk may only
+    fill half of the queue, so browsed folders always find room.
+    """
+    PRIORITY_FOLDER = 1
+    PRIORITY_SCAN = 2
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.executor = None
+        self.queue = queue.PriorityQueue(maxsize=queue_size)
+        self.order = itertools.count() # keeps FIFO order within one priority
+        self.jobs = {} # cache path -> future of a running job
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(workers * 2) # jobs handed to the process pool from the queue
+        self.scan_slots = threading.Semaphore(max(1, queue_size // 2))
+        self.scan_lock = threading.Lock()
+        self.last_scan = 0
+        self.warm_folders = {} # folder -> mtime when its files were last queued
+        self.walk_enabled = True
+        self.results = queue.SimpleQueue() # (cache, size, stages) of finished jobs, see finish()
+
+    @property
+    def running(self) -> bool:
+        return self.executor is not None
+
+    def start(self, walk=True) -> None:
+        """Start the workers. With walk off this process never walks the media folders, another server process does."""
+        if self.workers <= 0 or self.running: return
+        self.walk_enabled = walk
+        self.executor = self.create_executor()
+        threading.Thread(target=self.dispatch, name='thumbnail-dispatcher', daemon=True).start()
+        threading.Thread(target=self.account_results, name='thumbnail-accounting', daemon=True).start()
+        self.scan()
+
+    def stop(self) -> None:
+        """Stop the workers after their running jobs, queued jobs are dropped."""
+        if self.running: self.executor.shutdown(cancel_futures=True)
+
+    def create_executor(self) -> ProcessPoolExecutor:
+        # spawn is used everywhere, forking a process that already runs threads can deadlock
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, cache, cache_path, function, *args):
+        """
+        Run function(*args) in a worker right away and return its future, or the future of the job for the same
+        cache entry already running. The function has to write cache_path and return the number of bytes written
+        and a dictionary of stage durations.
+        """
+        with self.lock:
+            future = self.jobs.get(cache_path)
+            if future is None:
+                try: future = self.executor.submit(function, *args)
+                except BrokenProcessPool: # a worker crashed, e.g. on a broken file
+                    self.executor = self.create_executor()
+                    future = self.executor.submit(function, *args)
+                self.jobs[cache_path] = future
+                future.add_done_callback(lambda f: self.finish(cache, cache_path, f))
+        return future
+
+    def submit_thumbnail(self, full_path, cache_path):
+        return self.submit(thumbnail_cache, cache_path, generate_thumbnail, full_path, cache_path)
+
+    def finish(self, cache, cache_path, future) -> None:
+        with self.lock: self.jobs.pop(cache_path, None)
+        if future.cancelled() or future.exception() is not None: return
+        self.results.put((cache, *future.result()))
+
+    def account_results(self) -> None:
+        """
+        Add finished jobs to their cache size. finish() runs on the executor thread that delivers all job results,
+        and accounting may walk the whole cache (first use, recounts, eviction), so it happens in this thread instead.
+        """
+        while True:
+            cache, size, stages = self.results.get()
+            cache.account(size)
+            record_stages(stages)
+
+    def enqueue(self, full_path, priority) -> bool:
+        try: self.queue.put_nowait((priority, next(self.order), full_path))
+        except queue.Full: return False
+        return True
+
+    def dispatch(self) -> None:
+        while True:
+            priority, _, full_path = self.queue.get()
+            if priority == self.PRIORITY_SCAN: self.scan_slots.release()
+            try: cache_path = get_thumbnail_cache_path(get_thumbnail_key(full_path, os.stat(full_path)))
+            except OSError: continue
+            if os.path.isfile(cache_path): continue
+            self.slots.acquire()
+            try: future = self.submit_thumbnail(full_path, cache_path)
+            except RuntimeError: return # executor shut down at interpreter exit
+            future.add_done_callback(lambda _: self.slots.release())
+
+    def is_cached(self, full_path) -> bool:
+        try: return os.path.isfile(get_thumbnail_cache_path(get_thumbnail_key(full_path, os.stat(full_path))))
+        except OSError: return True # gone, nothing to generate
+
+    def prewarm_folder(self, folder) -> None:
+        """Queue the missing thumbnails of one folder ahead of the background walk."""
+        if not self.running: return
+        try: mtime = os.path.getmtime(folder)
+        except OSError: return
+        with self.lock:
+            if self.warm_folders.get(folder) == mtime: return
+            self.warm_folders[folder] = mtime
+        for entry in os.scandir(folder):
+            if entry.is_file() and is_media_file(entry.name) and not self.is_cached(entry.path):
+                if not self.enqueue(entry.path, self.PRIORITY_FOLDER): break
+
+    def scan(self) -> None:
+        """Walk PUBLIC_PATH and PRIVATE_PATH in a background thread unless a walk ran recently."""
+        if not self.running or not self.walk_enabled or datetime.now().timestamp() - self.last_scan < THUMBNAIL_RESCAN_INTERVAL: return
+        if not self.scan_lock.acquire(blocking=False): return
+        self.last_scan = datetime.now().timestamp()
+        threading.Thread(target=self.walk, name='thumbnail-scan', daemon=True).start()
+
+    def walk(self) -> None:
+        try:
+            for base_path in (PUBLIC_PATH, PRIVATE_PATH):
+                for root, _, files in os.walk(base_path, followlinks=True):
+                    for file in files:
+                        full_path = os.path.join(root, file)
+                        if not is_media_file(file) or self.is_cached(full_path): continue
+                        self.scan_slots.acquire() # blocks while the walk holds half of the queue
+                        if not self.enqueue(full_path, self.PRIORITY_SCAN): self.scan_slots.release()
+        finally:
+            self.scan_lock.release()
+
+thumbnail_pool = ThumbnailPool(max(1, THUMBNAIL_WORKERS // SERVER_PROCESSES) if THUMBNAIL_WORKERS > 0 else 0, THUMBNAIL_QUEUE_SIZE)
+
+def ensure_cached(cache, cache_path, function, *args) -> None:
+    """
+    Make sure a cache entry exists. function(*args) has to write it (see ThumbnailPool.submit); it runs in the
+    worker pool if that is running, otherwise in the request thread. Aborts with 503/500 if that fails.
+    """
+    if cache.lookup(cache_path): return
+    if thumbnail_pool.running:
+        try: thumbnail_pool.submit(cache, cache_path, function, *args).result(timeout=THUMBNAIL_WAIT_TIMEOUT)
+        except FutureTimeoutError: abort(503)
+        except Exception: abort(500)
+    else:
+        try: size, stages = function(*args)
+        except Exception: abort(500)
+        cache.account(size)
+        record_stages(stages)
+
+# --- Streaming ZIP ---
+ZIP_CHUNK_SIZE = 1024 * 1024
+download_slots = threading.BoundedSemaphore(MAX_CONCURRENT_DOWNLOADS)
+
+class ZipStream:
+    """Write-only file object for ZipFile that hands out everything written so far. It can't seek, so ZipFile writes data descriptors."""
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self) -> int: return self.offset
+    def flush(self) -> None: pass
+
+    def take(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def generate_zip(files):
+    """
+    Yield a ZIP archive of (full path, name in archive) pairs chunk by chunk, so memory use stays at about
+    ZIP_CHUNK_SIZE however big the files are. Already compressed media are STORED, ZIP64 is used where needed.
+    """
+    stream = ZipStream()
+    start = time.perf_counter()
+    with zipfile.ZipFile(stream, 'w') as zf:
+        for full_path, arcname in files:
+            try:
+                info = zipfile.ZipInfo.from_file(full_path, arcname)
+                info.compress_type = zipfile.ZIP_STORED if is_compressed_file(full_path) else zipfile.ZIP_DEFLATED
+                src = open(full_path, 'rb')
+            except OSError: continue # deleted since the folder was listed
+            with src, zf.open(info, 'w') as dest:
+                while chunk := src.read(ZIP_CHUNK_SIZE):
+                    dest.write(chunk)
+                    if len(stream.buffer) >= ZIP_CHUNK_SIZE: yield stream.take()
+            if stream.buffer: yield stream.take()
+    yield stream.take() # central directory
+    if METRICS_ENABLED: # bytes per second = rate of media_explorer_zip_bytes_total / rate of the zip stage
+        metrics.increment('media_explorer_zip_bytes_total', stream.offset)
+        metrics.observe('media_explorer_stage_seconds', time.perf_counter() - start, stage='zip')
 
 # --- Routes ---
 @app.route('/login', methods=['GET', 'POST'])
@@ -134,7 +1075,7 @@ def logout():
 @app.route('/')
 @login_required
 def index():
-    return render_template('index.html', username=current_user.username, title=PAGE_TITLE, group=current_user.group.split(",")[0], bg_name=get_bg_name(), now_year=str(datetime.now().year))
+    return render_template('index.html', username=current_user.username, title=PAGE_TITLE, group=current_user.groups[0] if current_user.groups else '', bg_name=get_bg_name(), now_year=str(datetime.now().year))
 
 # --- API and files ---
 @app.route('/api/gallery-data')
@@ -142,82 +1083,369 @@ def index():
 def gallery_data():
     os.makedirs(PUBLIC_PATH, exist_ok=True)
     os.makedirs(PRIVATE_PATH, exist_ok=True)
-    final_structure = []
-    
-    # Public folders
-    final_structure.extend(get_folder_structure(PUBLIC_PATH, PUBLIC_PATH, is_private=False))
-            
-    # Private folders
-    user_accesses = [access.folder_name for access in current_user.accesses]
-    for folder_name in sorted(user_accesses):
-        full_path = os.path.join(PRIVATE_PATH, folder_name)
-        if os.path.isdir(full_path):
-            private_folder = {'name': folder_name, 'type': 'folder', 'path': os.path.join(PRIVATE_DIRECTORY, folder_name), 'children': get_folder_structure(PRIVATE_PATH, full_path, is_private=True)}
-            if private_folder['children']: final_structure.append(private_folder)
-    
-    return json.dumps({"structure": final_structure})
-
-def check_access(filepath):
-    path_parts = filepath.replace('\\', '/').split('/')
-    if path_parts[0] == PRIVATE_DIRECTORY:
+    thumbnail_pool.scan()
+    refresh_catalog()
+    return catalog_response(lambda: {"structure": get_catalog_structure(current_user.folders, current_user.see_hidden)})
+
+@app.route('/api/folder/', defaults={'folderpath': ''})
+@app.route('/api/folder/<path:folderpath>')
+@login_required
+def folder_data(folderpath):
+    """
+    Lazy alternative to /api/gallery-data: one folder with its subfolders and a page of its media.
+    The empty path is the top level. Query parameters: sort (name/date), order (asc/desc), limit and cursor,
+    the next_cursor of the previous page.
+    """
+    folderpath = check_access(folderpath)
+    sort, descending, limit, cursor = get_page_args()
+
+    if not folderpath:
+        os.makedirs(PUBLIC_PATH, exist_ok=True)
+        os.makedirs(PRIVATE_PATH, exist_ok=True)
+    refresh_catalog()
+    folder = MediaFolder.query.filter_by(path=folderpath).first()
+    if folder is None: abort(404)
+    if folderpath: thumbnail_pool.prewarm_folder(get_full_path(folderpath))
+    return catalog_response(lambda: get_folder_page(folder, current_user.folders, current_user.see_hidden, sort, descending, limit, cursor))
+
+def get_page_args(default_sort='name', default_order='asc') -> tuple:
+    """The sort, descending, limit and cursor query parameters of a folder page."""
+    sort, order = request.args.get('sort', default_sort), request.args.get('order', default_order)
+    if sort not in ('name', 'date') or order not in ('asc', 'desc'): abort(400)
+    limit = min(max(request.args.get('limit', GALLERY_PAGE_SIZE, type=int), 1), GALLERY_MAX_PAGE_SIZE)
+    cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    if request.args.get('cursor') and cursor is None: abort(400)
+    return sort, order == 'desc', limit, cursor
+
+@app.route('/api/search')
+@login_required
+def search():
+    """
+    Media matching q (words matched against names, folders and cameras) in all folders the user can see.
+    Filters: type (image/video), from and to (dates YYYY-MM-DD, inclusive). Paging as in /api/folder,
+    sorted by date, newest first, by default.
+    """
+    sort, descending, limit, cursor = get_page_args('date', 'desc')
+    media_type = request.args.get('type') or None
+    if media_type not in (None, 'image', 'video'): abort(400)
+    try:
+        date_from, date_to = (datetime.strptime(request.args[name], '%Y-%m-%d').timestamp() if request.args.get(name) else None for name in ('from', 'to'))
+    except ValueError: abort(400)
+    if date_to is not None: date_to += 24 * 3600
+    refresh_catalog()
+    return catalog_response(lambda: search_media(current_user.folders, current_user.see_hidden, request.args.get('q', ''), media_type, date_from, date_to, sort, descending, limit, cursor))
+
+@app.route('/api/thumbnails/', defaults={'folderpath': ''})
+@app.route('/api/thumbnails/<path:folderpath>')
+@login_required
+def thumbnail_bundle(folderpath):
+    """
+    The thumbnails of one page of /api/folder/<path> (same query parameters) in a single response, so the access
+    check and the round-trip happen once per page instead of once per thumbnail. The body is a 4 byte big-endian
+    length of a JSON index, the index ({"items": [{"path", "offset", "length"}]}, offsets relative to the end of
+    the index) and the JPEG data. Thumbnails that could not be generated are left out; fetch them from /thumbnail.
+    """
+    folderpath = check_access(folderpath)
+    sort, descending, limit, cursor = get_page_args()
+    folder = MediaFolder.query.filter_by(path=folderpath).first()
+    if folder is None: abort(404)
+
+    entries = [] # (media path, full path, cache key, cache path)
+    for item in query_folder_items(folder, current_user.see_hidden, sort, descending, limit, cursor)[:limit]:
+        full_path = os.path.join(*split_media_path(item.path))
+        try: key = get_thumbnail_key(full_path, os.stat(full_path))
+        except OSError: continue
+        entries.append((item.path, full_path, key, get_thumbnail_cache_path(key)))
+    etag = hashlib.sha1('|'.join(entry[2] for entry in entries).encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag): return Response(status=304, headers={'ETag': f'"{etag}"'})
+
+    missing = [(full_path, cache_path) for _, full_path, _, cache_path in entries if not thumbnail_cache.lookup(cache_path)]
+    if thumbnail_pool.running:
+        futures = [thumbnail_pool.submit_thumbnail(full_path, cache_path) for full_path, cache_path in missing]
+        deadline = time.monotonic() + THUMBNAIL_WAIT_TIMEOUT
+        for future in futures:
+            try: future.result(timeout=max(0, deadline - time.monotonic()))
+            except Exception: pass
+    else:
+        for full_path, cache_path in missing:
+            try: size, stages = generate_thumbnail(full_path, cache_path)
+            except Exception: continue
+            thumbnail_cache.account(size)
+            record_stages(stages)
+
+    index, chunks, offset = [], [], 0
+    for path, _, _, cache_path in entries:
+        try:
+            with open(cache_path, 'rb') as f: data = f.read()
+        except OSError: continue
+        index.append({'path': path, 'offset': offset, 'length': len(data)})
+        chunks.append(data)
+        offset += len(data)
+    header = json.dumps({'items': index}).encode('utf-8')
+    response = Response(b''.join([len(header).to_bytes(4, 'big'), header] + chunks), mimetype='application/octet-stream')
+    if len(index) == len(entries): response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def check_access(filepath) -> str:
+    """
+    Abort unless the user may see a path used in URLs, and return it without empty segments. Paths with '.' or '..'
+    segments are refused (404), so the private folder that is checked is always the one that is served.
+    """
+    if any(part in ('.', '..') for part in filepath.replace('\\', '/').split('/')): abort(404)
+    path_parts = [part for part in filepath.split('/') if part]
+    if path_parts[:1] == [PRIVATE_DIRECTORY]:
         if len(path_parts) < 2: abort(403)
         folder_name = path_parts[1]
-        user_accesses = [access.folder_name for access in current_user.accesses]
-        if folder_name not in user_accesses: abort(403)
+        if folder_name not in current_user.folders: abort(403)
+    return '/'.join(path_parts)
 
 @app.route('/media/<path:filepath>')
 @login_required
 def serve_media(filepath):
-    check_access(filepath)
-    root_dir = PRIVATE_PATH if filepath.startswith(PRIVATE_DIRECTORY) else PUBLIC_PATH
-    path_to_file = filepath[len(PRIVATE_DIRECTORY)+1:] if filepath.startswith(PRIVATE_DIRECTORY) else filepath
-    log(f"🖼️ {current_user.username}: Loading {path_to_file}")
-    return send_from_directory(root_dir, path_to_file)
+    filepath = check_access(filepath)
+    root_dir, path_to_file = split_media_path(filepath)
+    log(f"🖼️ {current_user.username}: Loading {path_to_file}", event='media')
+    return private_cache(send_from_directory(root_dir, path_to_file))
 
 @app.route('/thumbnail/<path:filepath>')
 @login_required
 def serve_thumbnail(filepath):
-    check_access(filepath)
-    root_dir = PRIVATE_PATH if filepath.startswith(PRIVATE_DIRECTORY) else PUBLIC_PATH
-    path_to_file = filepath[len(PRIVATE_DIRECTORY)+1:] if filepath.startswith(PRIVATE_DIRECTORY) else filepath
-    
-    full_path = os.path.join(root_dir, path_to_file)
-    if not os.path.exists(full_path): abort(404)
-    img_io = io.BytesIO()
-    try:
-        if not is_video_file(filepath):
-            with Image.open(full_path) as img:
-                img = ImageOps.exif_transpose(img); img.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
-                img = img.convert('RGB'); img.save(img_io, 'JPEG', quality=85)
-        else:
-            cap = cv2.VideoCapture(full_path); ret, frame = cap.read(); cap.release()
-            if not ret: abort(500)
-            img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-            img.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS); img.save(img_io, 'JPEG', quality=85)
-        img_io.seek(0)
-        return send_file(img_io, mimetype='image/jpeg')
-    except Exception: abort(500)
+    filepath = check_access(filepath)
+    full_path = get_full_path(filepath)
+    try: stat = os.stat(full_path)
+    except OSError: abort(404)
+    key = get_thumbnail_key(full_path, stat)
+    cache_path = get_thumbnail_cache_path(key)
+    if not thumbnail_cache.lookup(cache_path): thumbnail_pool.prewarm_folder(os.path.dirname(full_path))
+    ensure_cached(thumbnail_cache, cache_path, generate_thumbnail, full_path, cache_path)
+    return private_cache(send_file(cache_path, mimetype='image/jpeg', etag=key, last_modified=stat.st_mtime))
+
+@app.route('/rendition/<int:size>/<path:filepath>')
+@login_required
+def serve_rendition(size, filepath):
+    """A resized copy of an image (long edge `size`, one of RENDITION_SIZES) for viewing, the original stays for downloads."""
+    if size not in RENDITION_SIZES or not has_renditions(filepath): abort(404)
+    filepath = check_access(filepath)
+    full_path = get_full_path(filepath)
+    try: stat = os.stat(full_path)
+    except OSError: abort(404)
+    image_format = get_rendition_format()
+    key = get_rendition_key(full_path, stat, size)
+    cache_path = rendition_cache.get_path(key, image_format.lower())
+    ensure_cached(rendition_cache, cache_path, generate_rendition, full_path, cache_path, size, image_format)
+    return private_cache(send_file(cache_path, mimetype=f"image/{image_format.lower()}", etag=key, last_modified=stat.st_mtime))
+
+def ensure_video_preview(filepath) -> tuple:
+    """Check access to a video and return its mtime, preview key and preview paths, generating the preview if needed."""
+    if not is_video_file(filepath): abort(404)
+    filepath = check_access(filepath)
+    full_path = get_full_path(filepath)
+    try: stat = os.stat(full_path)
+    except OSError: abort(404)
+    key = get_video_preview_key(full_path, stat)
+    paths = get_video_preview_paths(key)
+    if not (preview_cache.lookup(paths[0]) and preview_cache.lookup(paths[1])): # partly evicted, render again
+        try: os.remove(paths[2])
+        except OSError: pass
+    ensure_cached(preview_cache, paths[2], generate_video_preview, full_path, *paths)
+    return stat.st_mtime, key, paths
+
+@app.route('/video/manifest/<path:filepath>')
+@login_required
+def serve_video_manifest(filepath):
+    """Timing manifest of the sprite sheet of a video, with the URLs of the sprite sheet and the poster frame."""
+    _, key, (_, _, manifest_path) = ensure_video_preview(filepath)
+    with open(manifest_path, encoding='utf-8') as f: manifest = json.load(f)
+    manifest['poster'] = f"/video/poster/{quote(filepath)}"
+    manifest['sprite'] = f"/video/sprite/{quote(filepath)}"
+    response = jsonify(manifest)
+    response.set_etag(key, weak=True)
+    return private_cache(response.make_conditional(request))
+
+@app.route('/video/poster/<path:filepath>')
+@login_required
+def serve_video_poster(filepath):
+    mtime, key, (poster_path, _, _) = ensure_video_preview(filepath)
+    return private_cache(send_file(poster_path, mimetype='image/jpeg', etag=key, last_modified=mtime))
+
+@app.route('/video/sprite/<path:filepath>')
+@login_required
+def serve_video_sprite(filepath):
+    mtime, key, (_, sprite_path, _) = ensure_video_preview(filepath)
+    return private_cache(send_file(sprite_path, mimetype='image/jpeg', etag=key, last_modified=mtime))
+
+@app.route('/static/<path:filename>', endpoint='static')
+def serve_static(filename):
+    """Static files, precompressed if the client accepts it. Versioned URLs (?v=, see add_static_version) are immutable."""
+    asset = get_static_asset(filename)
+    if asset is None: abort(404)
+    encoding = request.accept_encodings.best_match(list(asset.encoded)) if asset.encoded else None
+    if encoding or asset.data is not None:
+        response = Response(asset.encoded[encoding] if encoding else asset.data, mimetype=asset.mimetype)
+        if encoding: response.headers['Content-Encoding'] = encoding
+        response.set_etag(f"{asset.version}-{encoding}" if encoding else asset.version)
+        response.last_modified = asset.mtime_ns / 1e9
+        response.make_conditional(request)
+    else:
+        response = send_file(asset.path, mimetype=asset.mimetype, etag=asset.version, last_modified=asset.mtime_ns / 1e9)
+    if asset.encoded: response.vary.add('Accept-Encoding')
+    if request.args.get('v') == asset.version:
+        response.cache_control.no_cache = None # set by send_file
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    else: response.cache_control.no_cache = True
+    return response
+
+@app.route('/metrics')
+@login_required
+def serve_metrics():
+    if not METRICS_ENABLED: abort(404)
+    if not current_user.is_admin: abort(403)
+    if server_index is None: return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+    return Response(metrics.render(str(server_index), read_shared_metrics()), mimetype='text/plain; version=0.0.4')
 
 @app.route('/download/section/<path:folderpath>')
 @login_required
 def download_section(folderpath):
-    check_access(folderpath)
-    root_dir = PRIVATE_PATH if folderpath.startswith(PRIVATE_DIRECTORY) else PUBLIC_PATH
-    path_to_folder = folderpath[len(PRIVATE_DIRECTORY)+1:] if folderpath.startswith(PRIVATE_DIRECTORY) else folderpath
-    section_path = os.path.join(root_dir, path_to_folder)
-    
+    folderpath = check_access(folderpath)
+    path_to_folder = split_media_path(folderpath)[1]
+    section_path = get_full_path(folderpath)
     log(f"💾 {current_user.username}: Downloading {path_to_folder}")
     if not os.path.isdir(section_path): abort(404)
-    memory_file = io.BytesIO()
-    with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for root, _, files in os.walk(section_path):
-            for file in files:
-                if is_media_file(file): zf.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), section_path))
-    memory_file.seek(0)
-    return send_file(memory_file, download_name=f"{os.path.basename(folderpath)}.zip", as_attachment=True)
+    if not download_slots.acquire(blocking=False):
+        log(f"    ⚠️ Too many downloads, refusing {path_to_folder}")
+        return Response("Too many downloads are running, try again later.", status=503, headers={'Retry-After': '60'})
+    files = []
+    for root, _, filenames in os.walk(section_path):
+        for file in sorted(filenames):
+            if is_media_file(file): files.append((os.path.join(root, file), os.path.relpath(os.path.join(root, file), section_path)))
+    download_name = f"{os.path.basename(folderpath)}.zip"
+    response = Response(generate_zip(files), mimetype='application/zip', headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(download_name)}"})
+    response.call_on_close(download_slots.release)
+    return response
+
+# --- Server processes ---
+# With SERVER_PROCESSES > 1 the main process binds PORT and starts that many server processes, which all accept
+# connections from the shared socket, so requests use more than one core. The main process only supervises them:
+# crashed ones are replaced, SIGHUP replaces them one by one with processes running the current app.py (a graceful
+# restart, Unix only) and SIGINT/SIGTERM stops them. A stopping server process stops accepting and finishes its
+# running requests first, for at most WORKER_SHUTDOWN_TIMEOUT seconds.
+class ServerWorker:
+    """A server process, serves requests from the shared listening socket until it gets SIGTERM."""
+    def __init__(self, sock, index):
+        self.sock = sock
+        self.index = index
+        self.server = None
+        self.stopping = False
+        self.drained = False
+
+    def run(self, ready) -> None:
+        global server_index
+        signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C reaches all processes, the main process stops the workers
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        server_index = self.index
+        if METRICS_ENABLED: threading.Thread(target=share_metrics, args=(self,), name='metrics-share', daemon=True).start()
+        load_static_assets()
+        start_background_work(walk=self.index == 0)
+        self.server = create_server(app, sockets=[self.sock], threads=SERVER_THREADS)
+        ready.set()
+        self.server.run()
+        thumbnail_pool.stop() # a process started by multiprocessing waits for its children when it exits
+
+    def handle_stop(self, signum, frame) -> None:
+        if self.drained: raise SystemExit # stops the server loop, see drain()
+        if self.stopping or self.server is None: return
+        self.stopping = True
+        self.server.accepting = False # new connections go to the other server processes
+        threading.Thread(target=self.drain, name='server-drain', daemon=True).start()
+
+    def is_busy(self) -> bool:
+        return bool(self.server.task_dispatcher.queue) or any(channel.requests or channel.total_outbufs_len for channel in list(self.server.active_channels.values()))
+
+    def drain(self) -> None:
+        deadline = time.time() + WORKER_SHUTDOWN_TIMEOUT
+        while self.is_busy() and time.time() < deadline: time.sleep(0.1)
+        self.drained = True
+        os.kill(os.getpid(), signal.SIGTERM)
+
+def start_background_work(walk=True) -> None:
+    """Start the thumbnail workers and the placeholder fill in a process that serves requests."""
+    global placeholder_fill_enabled
+    thumbnail_pool.start(walk)
+    placeholder_fill_enabled = True
+    start_placeholder_fill()
+
+def run_server_worker(sock, index, ready) -> None:
+    ServerWorker(sock, index).run(ready)
+
+class ServerSupervisor:
+    """Runs SERVER_PROCESSES server processes on one listening socket in the main process."""
+    def __init__(self, count):
+        self.count = count
+        self.context = multiprocessing.get_context('spawn') # like ThumbnailPool, a fresh interpreter per process
+        self.sock = socket.create_server(('0.0.0.0', PORT), backlog=1024)
+        self.workers = [None] * count
+        self.stopping_workers = [] # (process, kill at)
+        self.restart_requested = False
+        self.stop_requested = False
+
+    def start_worker(self, index):
+        ready = self.context.Event()
+        process = self.context.Process(target=run_server_worker, args=(self.sock, index, ready), name=f"server-{index}")
+        process.start()
+        if not ready.wait(60): log(f"⚠️ Server process {index} did not start in time", IP=False)
+        return process
+
+    def stop_worker(self, process) -> None:
+        process.terminate() # SIGTERM, a graceful stop on Unix
+        self.stopping_workers.append((process, time.time() + WORKER_SHUTDOWN_TIMEOUT + 10))
+
+    def run(self) -> None:
+        os.environ.setdefault('MEDIA_EXPLORER_SECRET_KEY', os.urandom(24).hex()) # sessions are valid in every process
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGTERM, self.request_stop)
+        if hasattr(signal, 'SIGHUP'): signal.signal(signal.SIGHUP, self.request_restart)
+        log(f"🚀 Starting server at port {PORT} with {self.count} processes...", IP=False)
+        self.workers = [self.start_worker(index) for index in range(self.count)]
+        while not self.stop_requested:
+            if self.restart_requested:
+                self.restart_requested = False
+                log("🔄 Restarting the server processes...", IP=False)
+                for index, process in enumerate(self.workers):
+                    self.workers[index] = self.start_worker(index) # the new process accepts before the old one stops
+                    self.stop_worker(process)
+            for index, process in enumerate(self.workers):
+                if not process.is_alive() and not self.stop_requested:
+                    log(f"⚠️ Server process {index} exited with code {process.exitcode}, starting a new one", IP=False)
+                    self.workers[index] = self.start_worker(index)
+            self.reap()
+            time.sleep(1)
+        log("🛑 Stopping the server processes...", IP=False)
+        for process in self.workers:
+            if process.is_alive(): self.stop_worker(process)
+        while self.stopping_workers:
+            self.reap()
+            time.sleep(0.2)
+
+    def reap(self) -> None:
+        """Forget stopped processes, kill the ones that didn't stop in time."""
+        for process, kill_at in list(self.stopping_workers):
+            if process.is_alive() and time.time() < kill_at: continue
+            if process.is_alive(): process.kill()
+            process.join()
+            self.stopping_workers.remove((process, kill_at))
+
+    def request_stop(self, signum, frame) -> None: self.stop_requested = True
+    def request_restart(self, signum, frame) -> None: self.restart_requested = True
 
 if __name__ == '__main__':
-    with app.app_context(): db.create_all()
-    # app.run(host='0.0.0.0', port=5000, debug=False)
-    log(f"🚀 Starting server at port {PORT}...", IP=False)
-    serve(app, host='0.0.0.0', port=PORT, threads=16)
+    with app.app_context(): init_db(); init_search_index(); scan_catalog()
+    if SERVER_PROCESSES > 1: ServerSupervisor(SERVER_PROCESSES).run()
+    else:
+        load_static_assets()
+        # app.run(host='0.0.0.0', port=5000, debug=False)
+        start_background_work()
+        log(f"🚀 Starting server at port {PORT}...", IP=False)
+        serve(app, host='0.0.0.0', port=PORT, threads=SERVER_THREADS)
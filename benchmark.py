@@ -0,0 +1,296 @@
+"""
+Benchmark of the media explorer server on a synthetic media library.
+
+Generates PUBLIC/PRIVATE trees and users in a temporary folder, times the cold start of app.py and manage_users.py,
+runs the main routes through the Flask test client and through a concurrent HTTP load against a local Waitress
+server, and prints (or saves) the results as JSON.
+Two result files can be compared with --compare.
+
+    python benchmark.py --folders 20 --images 50 --output before.json
+    python benchmark.py --folders 20 --images 50 --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import subprocess
+import argparse
+import platform
+import tempfile
+import threading
+import http.cookiejar
+import urllib.parse
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+try: import resource
+except ImportError: resource = None # Windows
+
+BENCH_PASSWORD = 'benchmark'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--folders', type=int, default=10, help="public folders")
+    parser.add_argument('--images', type=int, default=30, help="images per folder")
+    parser.add_argument('--videos', type=int, default=2, help="videos per folder")
+    parser.add_argument('--hidden', type=int, default=2, help="hidden images per folder")
+    parser.add_argument('--resolution', default='1920x1080', help="image resolution, WIDTHxHEIGHT")
+    parser.add_argument('--video-resolution', default='640x360', help="video resolution, WIDTHxHEIGHT")
+    parser.add_argument('--depth', type=int, default=3, help="maximum nesting of the public folders")
+    parser.add_argument('--users', type=int, default=5, help="users, each with a private folder")
+    parser.add_argument('--private-images', type=int, default=20, help="images per private folder")
+    parser.add_argument('--requests', type=int, default=200, help="requests per scenario of the HTTP load")
+    parser.add_argument('--concurrency', type=int, default=8, help="parallel clients of the HTTP load")
+    parser.add_argument('--threads', type=int, default=16, help="Waitress threads")
+    parser.add_argument('--startup-runs', type=int, default=5, help="fresh interpreters started per entry point to time the startup, 0 = skip")
+    parser.add_argument('--thumbnail-workers', type=int, default=0, help="background thumbnail processes, 0 = render inside requests")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', help="folder for the library and database (default: a temporary folder, deleted afterwards)")
+    parser.add_argument('--output', help="write the results to this JSON file instead of stdout")
+    parser.add_argument('--compare', help="results of an earlier run to compare with")
+    return parser.parse_args()
+
+def parse_resolution(value) -> tuple[int, int]:
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+# --- Library generator ---
+def make_image(path, size, seed) -> None:
+    """A noisy gradient, so decoding costs about as much as a real photo."""
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    width, height = size
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None] * np.ones((height, 1, 3), np.float32)
+    pixels = np.clip(gradient + rng.normal(0, 25, (height, width, 3)), 0, 255).astype(np.uint8)
+    Image.fromarray(pixels).save(path, 'JPEG', quality=90)
+
+def make_video(path, size, frames=60) -> None:
+    import numpy as np
+    import cv2
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), 30, size)
+    for i in range(frames):
+        frame = np.full((size[1], size[0], 3), (i * 4) % 256, np.uint8)
+        cv2.putText(frame, str(i), (20, size[1] // 2), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+        writer.write(frame)
+    writer.release()
+
+def generate_library(data_path, args) -> dict:
+    """Create PUBLIC and PRIVATE trees. Files are copies of one generated image/video, every copy is a separate file for the server."""
+    rng = random.Random(args.seed)
+    template_image = os.path.join(data_path, 'template.jpg')
+    template_video = os.path.join(data_path, 'template.mp4')
+    make_image(template_image, parse_resolution(args.resolution), args.seed)
+    if args.videos: make_video(template_video, parse_resolution(args.video_resolution))
+
+    public_folders = []
+    for i in range(args.folders):
+        parent = rng.choice(public_folders) if public_folders and rng.random() < 0.5 else ''
+        if parent.count('/') + 1 >= args.depth: parent = ''
+        folder = f"{parent}/Folder {i:04d}" if parent else f"Folder {i:04d}"
+        public_folders.append(folder)
+        full_folder = os.path.join(data_path, 'PUBLIC', folder)
+        os.makedirs(full_folder, exist_ok=True)
+        for j in range(args.images): shutil.copyfile(template_image, os.path.join(full_folder, f"IMG_{j:05d}.jpg"))
+        for j in range(args.hidden): shutil.copyfile(template_image, os.path.join(full_folder, f".hidden_{j:03d}.jpg"))
+        for j in range(args.videos): shutil.copyfile(template_video, os.path.join(full_folder, f"VID_{j:04d}.mp4"))
+
+    private_folders = [f"user{i:03d}" for i in range(args.users)]
+    for folder in private_folders + ['shared']:
+        full_folder = os.path.join(data_path, 'PRIVATE', folder)
+        os.makedirs(full_folder, exist_ok=True)
+        for j in range(args.private_images): shutil.copyfile(template_image, os.path.join(full_folder, f"IMG_{j:05d}.jpg"))
+    return {'public_folders': public_folders, 'private_folders': private_folders}
+
+def create_users(app_module, library) -> list[str]:
+    """One user per private folder, all in the group 'bench' with access to 'shared'. Every second user sees hidden files."""
+    from models import get_or_create_groups # like app, only imported once main() has set the environment config.py reads
+    db, User, FolderAccess = app_module.db, app_module.User, app_module.FolderAccess
+    usernames = []
+    with app_module.app.app_context():
+        app_module.init_db()
+        app_module.init_search_index()
+        groups = {}
+        bench, see_hidden = get_or_create_groups(['bench', '!see_hidden'], groups)
+        bench.accesses.append(app_module.GroupFolderAccess(folder_name='shared'))
+        for i, folder in enumerate(library['private_folders']):
+            user = User(username=folder)
+            user.set_password(BENCH_PASSWORD)
+            user.set_groups([bench, see_hidden] if i % 2 else [bench])
+            user.accesses.append(FolderAccess(folder_name=folder))
+            db.session.add(user)
+            usernames.append(folder)
+        db.session.commit()
+    return usernames
+
+# --- Measurements ---
+def peak_rss_mb():
+    if resource is None: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024, 1) # bytes on macOS, KiB elsewhere
+
+def percentile(sorted_values, fraction) -> float:
+    if not sorted_values: return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+def summarize(latencies, errors, elapsed, transferred) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies), 'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'bytes': transferred,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def run_client_scenario(client, urls, headers=None) -> dict:
+    """Requests one after another through the Flask test client, measures the app without networking."""
+    latencies, errors, transferred = [], 0, 0
+    start = time.perf_counter()
+    for url in urls:
+        request_start = time.perf_counter()
+        response = client.get(url, headers=headers or {})
+        transferred += len(response.get_data())
+        response.close() # runs the on-close callbacks, e.g. releasing the download slot
+        latencies.append(time.perf_counter() - request_start)
+        if response.status_code >= 400: errors += 1
+    return summarize(latencies, errors, time.perf_counter() - start, transferred)
+
+def login_opener(base_url, username):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    data = urllib.parse.urlencode({'username': username, 'password': BENCH_PASSWORD}).encode()
+    opener.open(f"{base_url}/login", data=data).read()
+    return opener
+
+def run_http_scenario(openers, base_url, urls, concurrency) -> dict:
+    """Requests spread over `concurrency` clients against the Waitress server, measures the app as deployed."""
+    latencies, errors, transferred = [], [0], [0]
+    lock = threading.Lock()
+    def fetch(i):
+        request_start = time.perf_counter()
+        try:
+            with openers[i % len(openers)].open(base_url + urllib.parse.quote(urls[i % len(urls)], safe='/?=&')) as response:
+                size = len(response.read())
+            failed = False
+        except (urllib.error.URLError, OSError): size, failed = 0, True
+        with lock:
+            latencies.append(time.perf_counter() - request_start)
+            transferred[0] += size
+            if failed: errors[0] += 1
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor: list(executor.map(fetch, range(len(urls))))
+    return summarize(latencies, errors[0], time.perf_counter() - start, transferred[0])
+
+def measure_startup(runs) -> dict:
+    """Cold start of the entry points, each run in a new interpreter: importing the server and listing the users."""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    commands = {'startup_import_app': [sys.executable, '-c', 'import app'],
+                'startup_manage_users': [sys.executable, os.path.join(base_dir, 'manage_users.py'), 'list']}
+    results = {}
+    for scenario, command in commands.items():
+        latencies, errors = [], 0
+        start = time.perf_counter()
+        for _ in range(runs):
+            run_start = time.perf_counter()
+            if subprocess.run(command, cwd=base_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0: errors += 1
+            latencies.append(time.perf_counter() - run_start)
+        results[scenario] = summarize(latencies, errors, time.perf_counter() - start, 0)
+    return results
+
+def media_paths(app_module, folder, limit) -> list[str]:
+    with app_module.app.app_context():
+        folder_row = app_module.MediaFolder.query.filter_by(path=folder).first()
+        items = app_module.MediaItem.query.filter_by(folder_id=folder_row.id).order_by(app_module.MediaItem.name).limit(limit)
+        return [item.path for item in items]
+
+def run_benchmark(app_module, library, usernames, args) -> dict:
+    results = {}
+    client = app_module.app.test_client()
+    client.post('/login', data={'username': usernames[-1], 'password': BENCH_PASSWORD})
+    folder = library['public_folders'][0]
+
+    results['catalog_scan_cold'] = run_client_scenario(client, ['/api/gallery-data'])
+    paths = media_paths(app_module, folder, args.images + args.videos)
+    results['gallery_data_warm'] = run_client_scenario(client, ['/api/gallery-data'] * 10)
+    results['folder_page'] = run_client_scenario(client, [f"/api/folder/{folder}"] * 20)
+    results['search'] = run_client_scenario(client, [f"/api/search?q={urllib.parse.quote(folder.rsplit('/', 1)[-1])}"] * 20)
+    results['thumbnail_cold'] = run_client_scenario(client, [f"/thumbnail/{path}" for path in paths])
+    results['thumbnail_warm'] = run_client_scenario(client, [f"/thumbnail/{path}" for path in paths])
+    etag = client.get(f"/thumbnail/{paths[0]}").headers.get('ETag')
+    results['thumbnail_not_modified'] = run_client_scenario(client, [f"/thumbnail/{paths[0]}"] * 50, headers={'If-None-Match': etag})
+    results['media'] = run_client_scenario(client, [f"/media/{path}" for path in paths])
+    results['download_section'] = run_client_scenario(client, [f"/download/section/{folder}"] * 3)
+
+    from waitress import create_server
+    server = create_server(app_module.app, host='127.0.0.1', port=0, threads=args.threads)
+    threading.Thread(target=server.run, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.effective_port}"
+    try:
+        openers = [login_opener(base_url, username) for username in usernames]
+        all_paths = []
+        for public_folder in library['public_folders']: all_paths += media_paths(app_module, public_folder, args.images + args.videos)
+        rng = random.Random(args.seed)
+        sample = lambda values: [rng.choice(values) for _ in range(args.requests)]
+        results['http_gallery_data'] = run_http_scenario(openers, base_url, ['/api/gallery-data'] * max(1, args.requests // 10), args.concurrency)
+        results['http_folder_page'] = run_http_scenario(openers, base_url, [f"/api/folder/{f}" for f in sample(library['public_folders'])], args.concurrency)
+        results['http_thumbnail'] = run_http_scenario(openers, base_url, [f"/thumbnail/{p}" for p in sample(all_paths)], args.concurrency)
+        results['http_media'] = run_http_scenario(openers, base_url, [f"/media/{p}" for p in sample(all_paths)], args.concurrency)
+        download_clients = min(args.concurrency, app_module.MAX_CONCURRENT_DOWNLOADS) # more would only measure the 503s
+        results['http_download_section'] = run_http_scenario(openers, base_url, [f"/download/section/{folder}"] * download_clients * 2, download_clients)
+    finally:
+        server.close()
+    return results
+
+# --- Comparison ---
+def compare(old, new) -> None:
+    print(f"\n{'scenario':<26}{'p50 ms':>24}{'p95 ms':>24}{'req/s':>24}", file=sys.stderr)
+    def cell(key, before, after):
+        if before is None or after is None: return f"{'-':>24}"
+        change = (after - before) / before * 100 if before else 0
+        return f"{f'{before:.1f} → {after:.1f} ({change:+.0f}%)':>24}"
+    for scenario, result in new['results'].items():
+        before = old['results'].get(scenario)
+        if not before: continue
+        print(f"{scenario:<26}{cell('p50', before['p50_ms'], result['p50_ms'])}{cell('p95', before['p95_ms'], result['p95_ms'])}{cell('rps', before['throughput_rps'], result['throughput_rps'])}", file=sys.stderr)
+
+def main() -> None:
+    args = parse_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='media-explorer-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    # app.py reads these on import
+    os.environ['MEDIA_EXPLORER_DATA'] = workdir
+    os.environ['MEDIA_EXPLORER_DATABASE'] = f"sqlite:///{os.path.join(workdir, 'benchmark.db')}"
+    try:
+        print(f"Generating library in {workdir}...", file=sys.stderr)
+        library = generate_library(workdir, args)
+        import app as app_module
+        app_module.LOG_FILE = os.path.join(workdir, 'server.log')
+        usernames = create_users(app_module, library)
+        results = measure_startup(args.startup_runs) if args.startup_runs > 0 else {} # before the thumbnail workers keep the CPU busy
+        app_module.thumbnail_pool.workers = args.thumbnail_workers
+        app_module.start_background_work()
+        print("Running scenarios...", file=sys.stderr)
+        results.update(run_benchmark(app_module, library, usernames, args))
+        report = {
+            'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'workdir')},
+            'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+            'results': results,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f: json.dump(report, f, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
+        if args.compare:
+            with open(args.compare, encoding='utf-8') as f: compare(json.load(f), report)
+    finally:
+        if not args.workdir: shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Settings of the media explorer, shared by app.py and manage_users.py."""
+import os
+
+# --- User config ---
+PUBLIC_DIRECTORY = 'PUBLIC'
+PRIVATE_DIRECTORY = 'PRIVATE'
+THUMBNAIL_SIZE = (300, 300)
+THUMBNAIL_QUALITY = 85
+CACHE_DIRECTORY = 'cache'
+THUMBNAIL_CACHE_LIMIT = 1024 * 1024 * 1024 # bytes, least recently used thumbnails are evicted above this
+RENDITION_SIZES = (1280, 2560) # long edge of the resized copies of images shown in the lightbox
+RENDITION_FORMAT = 'WEBP' # or 'JPEG', JPEG is also used if Pillow was built without WebP
+RENDITION_QUALITY = 82
+RENDITION_CACHE_LIMIT = 10 * 1024 * 1024 * 1024 # bytes
+PLACEHOLDER_SIZE = 16 # long edge of the tiny preview inlined in the gallery API and shown until the thumbnail is loaded
+VIDEO_POSTER_SIZE = 1280 # long edge of the frame shown before a video starts
+VIDEO_SPRITE_FRAMES = 60 # frames of the scrubbing preview of a video, at most one per second
+VIDEO_SPRITE_COLUMNS = 10
+VIDEO_SPRITE_TILE_WIDTH = 160
+PREVIEW_CACHE_LIMIT = 2 * 1024 * 1024 * 1024 # bytes
+THUMBNAIL_WORKERS = max(1, (os.cpu_count() or 2) // 2) # processes generating thumbnails in the background (split between the server processes), 0 = generate inside requests
+THUMBNAIL_QUEUE_SIZE = 10000 # pending background jobs
+THUMBNAIL_WAIT_TIMEOUT = 30 # seconds a request waits for its thumbnail
+THUMBNAIL_RESCAN_INTERVAL = 300 # seconds between walks of the media folders
+CATALOG_SCAN_INTERVAL = 30 # seconds, how old the media catalog may get before it is refreshed in the background
+GALLERY_PAGE_SIZE = 120 # media items per page of /api/folder
+GALLERY_MAX_PAGE_SIZE = 500
+MAX_CONCURRENT_DOWNLOADS = 4 # section downloads streamed at the same time per server process, more get 503
+ACCESS_CACHE_TTL = 300 # seconds a user's access rights are cached between database reads
+REVISION_CHECK_INTERVAL = 2 # seconds between checks for changes made by manage_users.py
+LOG_FILE = None # path of the log file, None = stdout
+LOG_FORMAT = 'text' # or 'json' for one JSON object per line
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024 # the log file is rotated above this size
+LOG_FILE_BACKUPS = 5
+LOG_RATE_LIMITS = {'media': 20} # lines per second written for an event, the rest is only counted
+MEDIA_MAX_AGE = 3600 # seconds browsers may reuse media, thumbnails and renditions before revalidating them
+STATIC_MAX_AGE = 365 * 24 * 3600 # seconds, for static files requested with their current version
+COMPRESS_MIN_SIZE = 1024 # bytes, smaller responses are sent uncompressed
+METRICS_ENABLED = False # collect latency histograms and counters, served to users in the '!admin' group at /metrics
+METRICS_SHARE_INTERVAL = 5 # seconds between writes of each server process's metrics, with SERVER_PROCESSES > 1
+PAGE_TITLE = "Media explorer"
+PORT = 5000
+SERVER_PROCESSES = int(os.environ.get('MEDIA_EXPLORER_PROCESSES', 1)) # processes serving requests on PORT, 1 = serve from the main process
+SERVER_THREADS = 16 # request threads per server process
+WORKER_SHUTDOWN_TIMEOUT = 30 # seconds a stopping server process waits for running requests, e.g. downloads
+SQLITE_WAL = True # write-ahead log, readers don't wait for writers
+SQLITE_BUSY_TIMEOUT = 30 # seconds a write waits for another process holding the database lock
+DATABASE_URI = os.environ.get('MEDIA_EXPLORER_DATABASE', 'sqlite:///photobook.db')
+DATA_DIR = os.environ.get('MEDIA_EXPLORER_DATA') # folder with PUBLIC, PRIVATE and the cache, default = next to app.py
+
+# --- Paths ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_PATH = os.path.abspath(DATA_DIR) if DATA_DIR else BASE_DIR
+PUBLIC_PATH = os.path.join(DATA_PATH, PUBLIC_DIRECTORY)
+PRIVATE_PATH = os.path.join(DATA_PATH, PRIVATE_DIRECTORY)
+THUMBNAIL_CACHE_PATH = os.path.join(DATA_PATH, CACHE_DIRECTORY, 'thumbnails')
+RENDITION_CACHE_PATH = os.path.join(DATA_PATH, CACHE_DIRECTORY, 'renditions')
+PREVIEW_CACHE_PATH = os.path.join(DATA_PATH, CACHE_DIRECTORY, 'previews')
+CATALOG_LOCK_PATH = os.path.join(DATA_PATH, CACHE_DIRECTORY, 'catalog.lock')
+METRICS_PATH = os.path.join(DATA_PATH, CACHE_DIRECTORY, 'metrics')
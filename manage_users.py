@@ -1,8 +1,17 @@
 import secrets
 import string
 import os
-from app import app, db, User, FolderAccess, PRIVATE_DIRECTORY, PRIVATE_PATH, PUBLIC_DIRECTORY, PUBLIC_PATH
-from collections import defaultdict
+import sys
+import csv
+import json
+import argparse
+from flask import Flask
+from sqlalchemy.orm import selectinload
+from config import PRIVATE_DIRECTORY, PRIVATE_PATH, PUBLIC_PATH
+from models import db, init_app, User, FolderAccess, Group, UserGroup, GroupFolderAccess, get_or_create_groups, init_db, bump_revision, AUTH_REVISION
+
+app = Flask(__name__) # only provides the app context of the database, the server in app.py is not imported
+init_app(app)
 
 # Path to the folder with private files
 
@@ -10,15 +19,29 @@ def generate_password(length=12):
     alphabet = string.ascii_letters + string.digits
     return ''.join(secrets.choice(alphabet) for _ in range(length))
 
+def load_users(usernames=None) -> dict[str, User]:
+    """Users by username with their accesses and groups, loaded in a fixed number of queries however many users there are."""
+    query = User.query.options(selectinload(User.accesses), selectinload(User.memberships).selectinload(UserGroup.group))
+    if usernames is not None: query = query.filter(User.username.in_(usernames))
+    return {user.username: user for user in query}
+
+def load_groups() -> dict[str, Group]:
+    """Groups by name with their members and folder grants."""
+    query = Group.query.options(selectinload(Group.accesses), selectinload(Group.memberships).selectinload(UserGroup.user))
+    return {group.name: group for group in query}
+
+def split_names(value, separator=',') -> list[str]:
+    return [name.strip() for name in value.split(separator) if name.strip()]
+
 def list_users():
-    users = User.query.all()
+    users = list(load_users().values())
     if not users:
         print("\nNo users found in the database.")
         return
     print("\n--- User List ---")
     for user in users:
         accesses = [acc.folder_name for acc in user.accesses]
-        print(f"  ID: {user.id}, Username: {user.username}, Access: {', '.join(accesses) or 'none'}, Groups: {user.group.split(',')}")
+        print(f"  ID: {user.id}, Username: {user.username}, Access: {', '.join(accesses) or 'none'}, Groups: {user.groups}")
     print("-----------------")
 
 def add_user():
@@ -34,8 +57,9 @@ def add_user():
     group = input("Enter user groups (leave empty for none, separate multiple with commas): ").strip().replace(" ", "")
     
     password = generate_password()
-    new_user = User(username=username, group=group)
+    new_user = User(username=username)
     new_user.set_password(password)
+    new_user.set_groups(get_or_create_groups(split_names(group), load_groups()))
     
     # Create personal folder and grant access
     personal_folder_path = os.path.join(PRIVATE_PATH, username)
@@ -44,7 +68,7 @@ def add_user():
     
     db.session.add(new_user)
     db.session.add(access)
-    db.session.commit()
+    bump_revision(AUTH_REVISION) # also commits, running servers reload access rights
     
     print("\nUser created successfully!")
     print(f"  Username 📝: {username}")
@@ -59,7 +83,7 @@ def delete_user():
     
     if input(f"Are you sure you want to delete user '{username}'? (yes/no): ").lower() == 'yes':
         db.session.delete(user)
-        db.session.commit()
+        bump_revision(AUTH_REVISION)
         print(f"User '{username}' and their access rights were deleted.")
     else:
         print("Action canceled.")
@@ -74,16 +98,16 @@ def change_password():
     if not new_password:
         new_password = generate_password()
     user.set_password(new_password)
-    db.session.commit()
+    bump_revision(AUTH_REVISION)
     print(f"Password for '{username}' was changed to: {new_password}")
 
 def manage_access():
     username = input("\nEnter username to manage access (leave empty for all users): ").strip()
     if not username:
-        users = User.query.all()
+        users = list(load_users().values())
     else:
-        users = [User.query.filter_by(username=username).first()]
-    if not users or users[0] is None:
+        users = list(load_users([username]).values())
+    if not users:
         print("User not found."); return
 
     while True:
@@ -101,65 +125,75 @@ def manage_access():
             case '3': break
             case _: continue
 
-def grant_access(users: list):
+def choose_private_folder():
+    """Ask for one of the folders in PRIVATE_PATH. Returns None if there is none or the answer is not one of them."""
     print("\nAvailable private folders:")
     try:
         os.makedirs(PRIVATE_PATH, exist_ok=True)
         private_folders = [f for f in os.listdir(PRIVATE_PATH) if (os.path.isdir(os.path.join(PRIVATE_PATH, f)) or os.path.islink(os.path.join(PRIVATE_PATH, f)))]
         if not private_folders:
-            print(f"No folders found in '{PRIVATE_DIRECTORY}'."); return
+            print(f"No folders found in '{PRIVATE_DIRECTORY}'."); return None
         for folder in private_folders: print(f"  - {folder}")
     except Exception as e:
-        print(f"Error while reading folders: {e}"); return
+        print(f"Error while reading folders: {e}"); return None
 
     folder_name = input("Enter folder name to grant access: ").strip()
     if folder_name not in private_folders:
-        print("Invalid folder name."); return
+        print("Invalid folder name."); return None
+    return folder_name
+
+def grant_access(users: list):
+    folder_name = choose_private_folder()
+    if folder_name is None: return
     for user in users:
-        if FolderAccess.query.filter_by(user_id=user.id, folder_name=folder_name).first():
-            print(f"User {user.username} already has access.")
-        else:
-            db.session.add(FolderAccess(user_id=user.id, folder_name=folder_name))
+        if not grant_folder(user, folder_name): print(f"User {user.username} already has access.")
 
-    db.session.commit()
+    bump_revision(AUTH_REVISION)
     print(f"Access to folder '{folder_name}' was granted.")
 
 def revoke_access(users: list):
     folder_name = input("\nEnter folder name to revoke access: ").strip()
     for user in users:
-        access = FolderAccess.query.filter_by(user_id=user.id, folder_name=folder_name).first()
-        if not access:
-            print("User does not have access to this folder."); return
-        
-        db.session.delete(access)
-    db.session.commit()
+        if not revoke_folder(user, folder_name): print(f"User {user.username} does not have access to this folder.")
+    bump_revision(AUTH_REVISION)
     print(f"Access to folder '{folder_name}' was revoked.")
 
+def grant_group_access(group):
+    folder_name = choose_private_folder()
+    if folder_name is None: return
+    if not grant_folder(group, folder_name):
+        print(f"Group {group.name} already has access."); return
+    bump_revision(AUTH_REVISION)
+    print(f"Access to folder '{folder_name}' was granted to all members of {group.name}.")
+
+def revoke_group_access(group):
+    folder_name = input("\nEnter folder name to revoke access: ").strip()
+    if not revoke_folder(group, folder_name):
+        print(f"Group {group.name} does not have access to this folder."); return
+    bump_revision(AUTH_REVISION)
+    print(f"Access to folder '{folder_name}' was revoked from {group.name}.")
+
+def grant_folder(owner, folder_name) -> bool:
+    """Add an access to a User or Group without committing. Returns False if it has it already."""
+    if any(access.folder_name == folder_name for access in owner.accesses): return False
+    owner.accesses.append(FolderAccess(folder_name=folder_name) if isinstance(owner, User) else GroupFolderAccess(folder_name=folder_name))
+    return True
+
+def revoke_folder(owner, folder_name) -> bool:
+    """Remove an access of a User or Group without committing. Returns False if it doesn't have it."""
+    accesses = [access for access in owner.accesses if access.folder_name == folder_name]
+    for access in accesses: owner.accesses.remove(access)
+    return bool(accesses)
+
 
 def get_groups() -> dict[str, list[str]]:
     """
-    Iterate through all users and return a dictionary where the key is the group name
-    and the value is a list of users in that group.
+    Return a dictionary where the key is the group name and the value is a list of users in that group.
 
     Returns:
         dict[str, list[str]]: Dictionary of groups and their members.
     """
-    groups = defaultdict(list)
-    all_users = User.query.all()
-
-    for user in all_users:
-        if not user.group:
-            continue
-
-        user_groups = user.group.split(',')
-
-        for group_name in user_groups:
-            # Clean group name and append the username under the group key
-            cleaned_name = group_name.strip()
-            if cleaned_name:
-                groups[cleaned_name].append(user.username)
-
-    return dict(groups)
+    return {name: [membership.user.username for membership in group.memberships] for name, group in load_groups().items()}
 
 def manage_groups():
     while True:
@@ -174,8 +208,8 @@ def manage_groups():
                     print("\nNo groups found in the database.")
                 else:
                     print("\n--- Group List ---")
-                    for group in groups:
-                        print(f"  {group} - {', '.join(groups[group])}")
+                    for name, group in load_groups().items():
+                        print(f"  {name} - {', '.join(groups[name]) or 'no members'}, Access: {', '.join(access.folder_name for access in group.accesses) or 'none'}")
                     print("-------------------")
             case '2': # Change user groups
                 while True:
@@ -187,9 +221,9 @@ def manage_groups():
                     else:
                         break
                 new_group = input("Enter group names (separate multiple with commas): ").strip().replace(" ", "")
-                user.set_group(new_group)
-                db.session.commit()
-                print(f"Groups for user {username} were changed to: {new_group.split(',')}.")
+                user.set_groups(get_or_create_groups(split_names(new_group), load_groups()))
+                bump_revision(AUTH_REVISION)
+                print(f"Groups for user {username} were changed to: {user.groups}.")
             case '3': # Grant access to a group
                 groups = get_groups()
                 while True:
@@ -198,7 +232,7 @@ def manage_groups():
                         print("\nGroup not found.")
                         continue
                     else: break
-                grant_access([User.query.filter_by(username=u).first() for u in groups[group]])
+                grant_group_access(load_groups()[group])
 
             case '4': # Revoke access from a group
                 groups = get_groups()
@@ -208,7 +242,7 @@ def manage_groups():
                         print("\nGroup not found.")
                         continue
                     else: break
-                revoke_access([User.query.filter_by(username=u).first() for u in groups[group]])
+                revoke_group_access(load_groups()[group])
             case '5': break
             case _: continue
 
@@ -226,9 +260,257 @@ def link_folder():
             os.system(f'mklink /D "{os.path.join(PRIVATE_PATH, os.path.basename(path))}" "{path}"')
     print(f"Folder {path} has been linked.")
 
+# --- Command line interface ---
+# With a subcommand the tool runs without questions, e.g. from provisioning scripts:
+#   python manage_users.py add alice --groups family
+#   python manage_users.py grant holidays --group family
+#   python manage_users.py import users.csv --dry-run
+# Bulk imports apply all changes in a single transaction; users, groups and accesses are read up front instead of
+# being looked up one by one. Exports list each group with its folders (a record with 'group' instead of 'username')
+# before the users, so groups without members and access granted to groups survive an export and import.
+EXPORT_FIELDS = ['username', 'group', 'groups', 'folders', 'password_hash']
+
+def fail(message):
+    raise SystemExit(f"Error: {message}")
+
+def get_users_or_fail(usernames) -> list[User]:
+    users = load_users(usernames)
+    missing = [username for username in usernames if username not in users]
+    if missing: fail(f"user not found: {', '.join(missing)}")
+    return [users[username] for username in usernames]
+
+def user_to_record(user) -> dict:
+    return {'username': user.username, 'groups': user.groups, 'folders': sorted(access.folder_name for access in user.accesses),
+            'password_hash': user.password_hash}
+
+def group_to_record(group) -> dict:
+    return {'group': group.name, 'folders': sorted(access.folder_name for access in group.accesses)}
+
+def write_records(records, file, file_format) -> None:
+    if file_format == 'json':
+        json.dump(records, file, indent=2, ensure_ascii=False); file.write('\n')
+        return
+    writer = csv.DictWriter(file, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for record in records: writer.writerow({**record, 'groups': ';'.join(record.get('groups', [])), 'folders': ';'.join(record['folders'])})
+
+def read_records(file, file_format) -> list[dict]:
+    """
+    User and group records of an import file. 'groups' and 'folders' are lists (separated by ';' in CSV, by ',' or ';'
+    in JSON strings). Records with 'group' instead of 'username' set the folders of a group. A missing field leaves
+    that part of an existing user or group unchanged. New users get 'password_hash', or 'password', or a random
+    password; 'password' is ignored for existing users so that imports can be repeated.
+    """
+    rows = json.load(file) if file_format == 'json' else list(csv.DictReader(file))
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows): fail("expected a list of user and group records")
+    records = []
+    for line, row in enumerate(rows, start=1):
+        username, group = (str(row.get(field) or '').strip() for field in ('username', 'group'))
+        if username and group: fail(f"record {line} has both a username and a group")
+        if not username and not group: fail(f"record {line} has no username")
+        record = {'username': username} if username else {'group': group.replace(' ', '')}
+        for field in ('groups', 'folders') if username else ('folders',):
+            value = row.get(field)
+            if isinstance(value, str): value = split_names(value.replace(',', ';') if file_format == 'json' else value, ';')
+            if value is not None: record[field] = [str(name).strip().replace(' ', '') if field == 'groups' else str(name).strip() for name in value if str(name).strip()]
+        for field in ('password', 'password_hash'):
+            if row.get(field): record[field] = str(row[field])
+        records.append(record)
+    return records
+
+def import_records(records, prune=False, dry_run=False) -> tuple[list[str], dict[str, str]]:
+    """
+    Create or update groups and users from records (see read_records) and, with prune, delete users that are not
+    listed. Returns the changes and the generated passwords. All changes are committed together, or none with dry_run.
+    """
+    users, known_groups = load_users(), load_groups()
+    changes, passwords, seen = [], {}, set()
+    for record in sorted(records, key=lambda record: 'group' not in record): # groups first, users may join them
+        if 'group' in record:
+            if ('group', record['group']) in seen: fail(f"group {record['group']} is listed twice")
+            seen.add(('group', record['group']))
+            changes += import_group(record, known_groups, dry_run)
+            continue
+        username = record['username']
+        if username in seen: fail(f"user {username} is listed twice")
+        seen.add(username)
+        groups, folders = record.get('groups'), record.get('folders')
+        user = users.get(username)
+        if user is None:
+            changes.append(f"+ {username}: groups {','.join(groups or []) or 'none'}, folders {', '.join(folders or []) or 'none'}")
+            if dry_run: continue
+            user = User(username=username)
+            user.set_groups(get_or_create_groups(groups or [], known_groups))
+            if record.get('password_hash'): user.password_hash = record['password_hash']
+            else:
+                passwords[username] = record.get('password') or generate_password()
+                user.set_password(passwords[username])
+            for folder_name in folders or []: grant_folder(user, folder_name)
+            db.session.add(user)
+            continue
+
+        diff = []
+        if groups is not None and user.groups != groups:
+            diff.append(f"groups {','.join(user.groups) or 'none'} -> {','.join(groups) or 'none'}")
+            if not dry_run: user.set_groups(get_or_create_groups(groups, known_groups))
+        if folders is not None:
+            current = {access.folder_name for access in user.accesses}
+            diff += [f"+folder {name}" for name in folders if name not in current] + [f"-folder {name}" for name in sorted(current - set(folders))]
+            if not dry_run:
+                for name in folders: grant_folder(user, name)
+                for name in current - set(folders): revoke_folder(user, name)
+        if record.get('password_hash') and record['password_hash'] != user.password_hash:
+            diff.append("password changed")
+            if not dry_run: user.password_hash = record['password_hash']
+        if diff: changes.append(f"~ {username}: {', '.join(diff)}")
+
+    if prune:
+        for username in sorted(set(users) - seen):
+            changes.append(f"- {username}")
+            if not dry_run: db.session.delete(users[username])
+    if dry_run or not changes: db.session.rollback()
+    else: bump_revision(AUTH_REVISION)
+    return changes, passwords
+
+def import_group(record, known_groups, dry_run) -> list[str]:
+    """Create a group of a record or update its folders, returns the changes."""
+    name, folders = record['group'], record.get('folders')
+    group = known_groups.get(name)
+    if group is None:
+        if not dry_run:
+            group, = get_or_create_groups([name], known_groups)
+            for folder_name in folders or []: grant_folder(group, folder_name)
+        return [f"+ group {name}: folders {', '.join(folders or []) or 'none'}"]
+    if folders is None: return []
+    current = {access.folder_name for access in group.accesses}
+    diff = [f"+folder {folder_name}" for folder_name in folders if folder_name not in current] + [f"-folder {folder_name}" for folder_name in sorted(current - set(folders))]
+    if not dry_run:
+        for folder_name in folders: grant_folder(group, folder_name)
+        for folder_name in current - set(folders): revoke_folder(group, folder_name)
+    return [f"~ group {name}: {', '.join(diff)}"] if diff else []
+
+def get_file_format(args, path) -> str:
+    return args.format or ('json' if path and path.lower().endswith('.json') else 'csv')
+
+def cmd_list(args):
+    if args.json: write_records([user_to_record(user) for user in load_users().values()], sys.stdout, 'json')
+    else: list_users()
+
+def cmd_add(args):
+    if load_users([args.username]): fail(f"user {args.username} already exists")
+    password = args.password or generate_password()
+    user = User(username=args.username)
+    user.set_password(password)
+    user.set_groups(get_or_create_groups(split_names(args.groups), load_groups()))
+    if not args.no_folder:
+        os.makedirs(os.path.join(PRIVATE_PATH, args.username), exist_ok=True)
+        grant_folder(user, args.username)
+    db.session.add(user)
+    bump_revision(AUTH_REVISION)
+    print(f"{args.username}\t{password}")
+
+def cmd_delete(args):
+    for user in get_users_or_fail(args.usernames): db.session.delete(user)
+    bump_revision(AUTH_REVISION)
+    print(f"Deleted {len(args.usernames)} user(s).")
+
+def cmd_passwd(args):
+    user, = get_users_or_fail([args.username])
+    password = args.password or generate_password()
+    user.set_password(password)
+    bump_revision(AUTH_REVISION)
+    print(f"{args.username}\t{password}")
+
+def get_target_users(args) -> list[User]:
+    if args.all: return list(load_users().values())
+    if not args.usernames: fail("name users, or use --group or --all")
+    return get_users_or_fail(args.usernames)
+
+def get_group_or_fail(name) -> Group:
+    group = Group.query.options(selectinload(Group.accesses)).filter_by(name=name).first()
+    if group is None: fail(f"group not found: {name}")
+    return group
+
+def cmd_grant(args):
+    if not os.path.isdir(os.path.join(PRIVATE_PATH, args.folder)): print(f"Warning: '{args.folder}' is not a folder in {PRIVATE_DIRECTORY}.", file=sys.stderr)
+    if args.group:
+        group, = get_or_create_groups([args.group], load_groups())
+        changed = grant_folder(group, args.folder)
+        bump_revision(AUTH_REVISION)
+        print(f"Access to '{args.folder}' {'granted to' if changed else 'was already granted to'} group {args.group}.")
+        return
+    changed = [user.username for user in get_target_users(args) if grant_folder(user, args.folder)]
+    bump_revision(AUTH_REVISION)
+    print(f"Access to '{args.folder}' granted to {len(changed)} user(s): {', '.join(changed) or 'none'}")
+
+def cmd_revoke(args):
+    if args.group:
+        changed = revoke_folder(get_group_or_fail(args.group), args.folder)
+        bump_revision(AUTH_REVISION)
+        print(f"Access to '{args.folder}' {'revoked from' if changed else 'was not granted to'} group {args.group}.")
+        return
+    changed = [user.username for user in get_target_users(args) if revoke_folder(user, args.folder)]
+    bump_revision(AUTH_REVISION)
+    print(f"Access to '{args.folder}' revoked from {len(changed)} user(s): {', '.join(changed) or 'none'}")
+
+def cmd_group(args):
+    if args.action == 'list':
+        for group, members in sorted(get_groups().items()): print(f"{group}\t{', '.join(members)}")
+        return
+    if args.groups is None: fail("group set needs USERNAME and GROUPS")
+    user, = get_users_or_fail([args.username])
+    user.set_groups(get_or_create_groups(split_names(args.groups), load_groups()))
+    bump_revision(AUTH_REVISION)
+    print(f"Groups for user {user.username} were changed to: {user.groups}.")
+
+def cmd_export(args):
+    groups = [group_to_record(group) for _, group in sorted(load_groups().items())]
+    records = groups + [user_to_record(user) for user in sorted(load_users().values(), key=lambda user: user.username)]
+    if not args.file: write_records(records, sys.stdout, get_file_format(args, None)); return
+    with open(args.file, 'w', newline='', encoding='utf-8') as f: write_records(records, f, get_file_format(args, args.file))
+    print(f"Exported {len(records) - len(groups)} user(s) and {len(groups)} group(s) to {args.file}.", file=sys.stderr)
+
+def cmd_import(args):
+    file_format = get_file_format(args, args.file)
+    if args.file == '-': records = read_records(sys.stdin, file_format)
+    else:
+        with open(args.file, newline='', encoding='utf-8-sig') as f: records = read_records(f, file_format)
+    changes, passwords = import_records(records, prune=args.prune, dry_run=args.dry_run)
+    for change in changes: print(change)
+    print(f"{len(changes)} change(s){' (dry run, nothing was written)' if args.dry_run else ''}.", file=sys.stderr)
+    for username, password in passwords.items(): print(f"{username}\t{password}")
+
+def run_command(argv):
+    parser = argparse.ArgumentParser(description="Manage users, groups and folder access. Without a command an interactive menu is shown.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('list', help="list users"); command.set_defaults(func=cmd_list)
+    command.add_argument('--json', action='store_true', help="print the users as JSON records")
+    command = commands.add_parser('add', help="add a user, prints the username and password"); command.set_defaults(func=cmd_add)
+    command.add_argument('username'); command.add_argument('--groups', default='', help="comma separated groups")
+    command.add_argument('--password', help="default: random"); command.add_argument('--no-folder', action='store_true', help="don't create and grant a personal private folder")
+    command = commands.add_parser('delete', help="delete users"); command.set_defaults(func=cmd_delete)
+    command.add_argument('usernames', nargs='+')
+    command = commands.add_parser('passwd', help="set a password, prints the username and password"); command.set_defaults(func=cmd_passwd)
+    command.add_argument('username'); command.add_argument('--password', help="default: random")
+    for name, func in (('grant', cmd_grant), ('revoke', cmd_revoke)):
+        command = commands.add_parser(name, help=f"{name} access to a private folder"); command.set_defaults(func=func)
+        command.add_argument('folder'); command.add_argument('usernames', nargs='*')
+        command.add_argument('--group', help="a group, applies to all its current and future members"); command.add_argument('--all', action='store_true', help="all users")
+    command = commands.add_parser('group', help="list groups or set the groups of a user"); command.set_defaults(func=cmd_group)
+    command.add_argument('action', choices=['list', 'set']); command.add_argument('username', nargs='?'); command.add_argument('groups', nargs='?')
+    command = commands.add_parser('export', help="write users, groups and folder access as CSV or JSON"); command.set_defaults(func=cmd_export)
+    command.add_argument('file', nargs='?', help="default: stdout"); command.add_argument('--format', choices=['csv', 'json'], help="default: from the file name, else CSV")
+    command = commands.add_parser('import', help="create and update users from a CSV or JSON export in one transaction"); command.set_defaults(func=cmd_import)
+    command.add_argument('file', help="'-' for stdin"); command.add_argument('--format', choices=['csv', 'json'], help="default: from the file name, else CSV")
+    command.add_argument('--dry-run', action='store_true', help="only print the changes"); command.add_argument('--prune', action='store_true', help="delete users missing from the file")
+    args = parser.parse_args(argv)
+    with app.app_context():
+        init_db()
+        args.func(args)
+
 def main_menu():
     with app.app_context():
-        db.create_all()
+        init_db()
 
     while True:
         print("\n===== User Management =====")
@@ -245,6 +527,9 @@ def main_menu():
                 print("Invalid choice.")
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run_command(sys.argv[1:])
+        exit()
     try:
         main_menu()
     except KeyboardInterrupt:
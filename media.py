@@ -0,0 +1,273 @@
+"""
+Reading and rendering media files: EXIF data, thumbnails, renditions, video previews and placeholders.
+
+The generate_* and make_* functions run inside the worker processes of app.ThumbnailPool. Pillow and OpenCV are
+imported inside the functions that use them, on first use: importing OpenCV alone takes longer than the rest of
+the server, and a process that never touches a video (or an image) never loads it.
+"""
+import os
+import io
+import json
+import math
+import time
+import base64
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from config import (THUMBNAIL_SIZE, THUMBNAIL_QUALITY, RENDITION_FORMAT, RENDITION_QUALITY, PLACEHOLDER_SIZE, VIDEO_POSTER_SIZE,
+                    VIDEO_SPRITE_FRAMES, VIDEO_SPRITE_COLUMNS, VIDEO_SPRITE_TILE_WIDTH)
+try: import fcntl # file locks on Unix, msvcrt on Windows
+except ImportError: fcntl = None; import msvcrt
+
+# --- Process locks ---
+# Server processes and their thumbnail workers share the cache folders, the catalog and the log file. An exclusive
+# lock on a lock file makes sure only one of them creates a cache entry, scans the catalog or rotates the log.
+@contextmanager
+def file_lock(path, blocking=True):
+    """Hold an exclusive lock on the file path across processes. Yields False if blocking is off and the lock is taken."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a+b') as f:
+        try:
+            if fcntl: fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else: lock_windows_file(f, blocking)
+        except OSError:
+            yield False
+            return
+        try: yield True
+        finally:
+            if not fcntl:
+                f.seek(0); msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def lock_windows_file(f, blocking) -> None:
+    f.seek(0)
+    while True: # LK_LOCK gives up after 10 seconds
+        try: msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1); return
+        except OSError:
+            if not blocking: raise
+
+# --- File types ---
+def is_media_file(filename):
+    ext = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp4', '.mov', '.mkv'}
+    return os.path.splitext(filename)[1].lower() in ext
+
+def is_compressed_file(filename):
+    """Formats that are already compressed, deflating them again only costs CPU."""
+    ext = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp4', '.mov', '.mkv', '.webm'}
+    return os.path.splitext(filename)[1].lower() in ext
+
+def is_video_file(filename):
+    ext = {'.mp4', '.mov', '.mkv', '.webm'}
+    return os.path.splitext(filename)[1].lower() in ext
+
+def has_renditions(filename):
+    """Images shown through renditions. GIFs may be animated and renditions only keep the first frame, they are sent as they are."""
+    return not is_video_file(filename) and os.path.splitext(filename)[1].lower() != '.gif'
+
+# --- Metadata ---
+def read_image_info(full_path) -> tuple:
+    """
+    Capture time (timestamp) and camera from the EXIF data and the displayed width and height of an image, None
+    where missing. Only reads the header.
+    """
+    from PIL import Image
+    try:
+        with Image.open(full_path) as img: exif, (width, height) = img.getexif(), img.size
+        taken = exif.get_ifd(0x8769).get(36867) or exif.get(306) # DateTimeOriginal, DateTime
+    except Exception: return None, None, None, None
+    if exif.get(274) in (5, 6, 7, 8): width, height = height, width # Orientation, rotated by 90°
+    try: taken_at = datetime.strptime(str(taken).strip('\x00 ')[:19], '%Y:%m:%d %H:%M:%S').timestamp() if taken else None
+    except ValueError: taken_at = None
+    make, model = (str(exif.get(tag) or '').strip('\x00 ') for tag in (271, 272))
+    camera = model if model.startswith(make) else f"{make} {model}".strip()
+    return taken_at, camera or None, width, height
+
+def make_placeholders(jobs) -> list[tuple]:
+    """make_placeholder() for a list of (full path, type). Runs inside the worker processes of ThumbnailPool."""
+    return [make_placeholder(full_path, media_type) for full_path, media_type in jobs]
+
+def make_placeholder(full_path, media_type) -> tuple:
+    """Width, height (None for images, the scan reads them) and placeholder of a media file. The placeholder is '' on errors."""
+    from PIL import Image, ImageOps
+    try:
+        if media_type == 'image':
+            with Image.open(full_path) as img:
+                img.draft('RGB', (PLACEHOLDER_SIZE * 4, PLACEHOLDER_SIZE * 4)) # JPEGs decode at 1/8 of their size
+                return None, None, encode_placeholder(ImageOps.exif_transpose(img))
+        cap, duration = open_video(full_path)
+        try: frame = pick_poster_frame(cap, duration)
+        finally: cap.release()
+        return frame.shape[1], frame.shape[0], encode_placeholder(frame_to_image(frame))
+    except Exception: return None, None, ''
+
+def encode_placeholder(img) -> str:
+    from PIL import Image, features
+    img = img.convert('RGB')
+    img.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.Resampling.BOX)
+    image_format = 'WEBP' if features.check('webp') else 'PNG'
+    img_io = io.BytesIO()
+    img.save(img_io, image_format, quality=50)
+    return f"data:image/{image_format.lower()};base64,{base64.b64encode(img_io.getvalue()).decode('ascii')}"
+
+# --- Rendering ---
+class StageTimer:
+    """Durations of the consecutive stages of one job, e.g. decode, resize and encode of a thumbnail."""
+    def __init__(self):
+        self.stages = {}
+        self.last = time.perf_counter()
+
+    def lap(self, stage) -> None:
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0) + now - self.last
+        self.last = now
+
+def entry_lock(cache_path):
+    """
+    The lock held while a cache entry is created. Entries of one cache subfolder (a 1/256 shard by key) share a
+    lock file, so locking doesn't add a file per entry; two renders only wait for each other if their keys collide.
+    """
+    return file_lock(os.path.join(os.path.dirname(cache_path), 'entries.lock'))
+
+def write_cache_file(cache_path, data) -> None:
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f: f.write(data)
+    os.replace(temp_path, cache_path) # atomic, readers never see a half written file
+
+# Thumbnails
+def render_thumbnail(full_path, timer) -> bytes:
+    from PIL import Image, ImageOps
+    img_io = io.BytesIO()
+    if not is_video_file(full_path):
+        with Image.open(full_path) as img:
+            img.load(); timer.lap('image_decode')
+            img = ImageOps.exif_transpose(img); img.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+            img = img.convert('RGB'); timer.lap('resize')
+            img.save(img_io, 'JPEG', quality=THUMBNAIL_QUALITY); timer.lap('encode')
+    else:
+        cap, duration = open_video(full_path)
+        try: frame = pick_poster_frame(cap, duration)
+        finally: cap.release()
+        img = frame_to_image(frame); timer.lap('video_decode')
+        img.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS); timer.lap('resize')
+        img.save(img_io, 'JPEG', quality=THUMBNAIL_QUALITY); timer.lap('encode')
+    return img_io.getvalue()
+
+def generate_thumbnail(full_path, cache_path) -> tuple[int, dict]:
+    """
+    Render and store one thumbnail, returns its size and stage durations (size 0 if another process stored it
+    meanwhile). Runs inside the worker processes of ThumbnailPool.
+    """
+    timer = StageTimer()
+    with entry_lock(cache_path):
+        if os.path.isfile(cache_path): return 0, timer.stages
+        data = render_thumbnail(full_path, timer)
+        write_cache_file(cache_path, data)
+    return len(data), timer.stages
+
+# Renditions, smaller copies of images for viewing them in the browser
+def get_rendition_format() -> str:
+    from PIL import features
+    return 'WEBP' if RENDITION_FORMAT == 'WEBP' and features.check('webp') else 'JPEG'
+
+def render_rendition(full_path, size, image_format, timer) -> bytes:
+    from PIL import Image, ImageOps
+    img_io = io.BytesIO()
+    with Image.open(full_path) as img:
+        img.draft('RGB', (size, size)) # lets JPEG decode at a reduced scale that is still at least `size`
+        img.load(); timer.lap('image_decode')
+        img = ImageOps.exif_transpose(img); img.thumbnail((size, size), Image.Resampling.LANCZOS)
+        img = img.convert('RGBA' if image_format == 'WEBP' and img.mode in ('RGBA', 'LA', 'P') else 'RGB'); timer.lap('resize')
+        img.save(img_io, image_format, quality=RENDITION_QUALITY); timer.lap('encode')
+    return img_io.getvalue()
+
+def generate_rendition(full_path, cache_path, size, image_format) -> tuple[int, dict]:
+    """Render and store one rendition, returns its size and stage durations. Runs inside the worker processes of ThumbnailPool."""
+    timer = StageTimer()
+    with entry_lock(cache_path):
+        if os.path.isfile(cache_path): return 0, timer.stages
+        data = render_rendition(full_path, size, image_format, timer)
+        write_cache_file(cache_path, data)
+    return len(data), timer.stages
+
+# Video previews, a poster frame and a sprite sheet of frames at fixed intervals with a manifest for scrubbing.
+# Frames are found by seeking, so even long videos are not decoded from the start.
+VIDEO_POSTER_POSITIONS = (0.1, 0.25, 0.5, 0) # fractions of the duration tried for the poster frame
+
+def open_video(full_path):
+    """Return an opened cv2.VideoCapture and the duration in seconds (0 if the container doesn't tell)."""
+    import cv2
+    cap = cv2.VideoCapture(full_path)
+    if not cap.isOpened(): raise ValueError(f"Could not open {full_path}")
+    fps, frame_count = cap.get(cv2.CAP_PROP_FPS), cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    return cap, frame_count / fps if fps > 0 and frame_count > 0 else 0
+
+def read_frame_at(cap, seconds):
+    import cv2
+    cap.set(cv2.CAP_PROP_POS_MSEC, seconds * 1000)
+    ret, frame = cap.read()
+    return frame if ret else None
+
+def pick_poster_frame(cap, duration):
+    """The first frame at VIDEO_POSTER_POSITIONS that is neither dark nor flat, otherwise the most detailed one."""
+    import cv2
+    best_frame, best_detail = None, -1
+    for fraction in VIDEO_POSTER_POSITIONS if duration else (0,):
+        frame = read_frame_at(cap, duration * fraction)
+        if frame is None: continue
+        mean, deviation = cv2.meanStdDev(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+        if mean[0][0] > 30 and deviation[0][0] > 20: return frame
+        if deviation[0][0] > best_detail: best_frame, best_detail = frame, deviation[0][0]
+    if best_frame is None: raise ValueError("Could not read any frame")
+    return best_frame
+
+def frame_to_image(frame):
+    """A PIL image of an OpenCV (BGR) frame."""
+    import cv2
+    from PIL import Image
+    return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+def encode_jpeg(img, quality) -> bytes:
+    img_io = io.BytesIO()
+    img.save(img_io, 'JPEG', quality=quality)
+    return img_io.getvalue()
+
+def generate_video_preview(full_path, poster_path, sprite_path, manifest_path) -> tuple[int, dict]:
+    """Render and store the poster, sprite sheet and manifest of a video unless another process did. Runs inside the worker processes of ThumbnailPool."""
+    import cv2
+    from PIL import Image
+    timer = StageTimer()
+    with entry_lock(manifest_path):
+        if os.path.isfile(manifest_path): return 0, timer.stages
+        cap, duration = open_video(full_path)
+        try:
+            poster = pick_poster_frame(cap, duration)
+            count = max(1, min(VIDEO_SPRITE_FRAMES, int(duration)))
+            interval = duration / count
+            tiles = [(interval * (i + 0.5), read_frame_at(cap, interval * (i + 0.5))) for i in range(count)] if duration else []
+            tiles = [(seconds, frame) for seconds, frame in tiles if frame is not None] or [(0, poster)]
+        finally: cap.release()
+        timer.lap('video_decode')
+
+        poster_img = frame_to_image(poster)
+        poster_img.thumbnail((VIDEO_POSTER_SIZE, VIDEO_POSTER_SIZE), Image.Resampling.LANCZOS)
+        tile_width = VIDEO_SPRITE_TILE_WIDTH
+        tile_height = max(1, round(tile_width * poster.shape[0] / poster.shape[1]))
+        columns = min(VIDEO_SPRITE_COLUMNS, len(tiles))
+        rows = math.ceil(len(tiles) / columns)
+        sheet = Image.new('RGB', (columns * tile_width, rows * tile_height))
+        frames = []
+        for index, (seconds, frame) in enumerate(tiles):
+            x, y = index % columns * tile_width, index // columns * tile_height
+            sheet.paste(frame_to_image(cv2.resize(frame, (tile_width, tile_height), interpolation=cv2.INTER_AREA)), (x, y))
+            frames.append({'time': round(seconds, 3), 'x': x, 'y': y})
+        timer.lap('resize')
+
+        poster_data, sprite_data = encode_jpeg(poster_img, RENDITION_QUALITY), encode_jpeg(sheet, THUMBNAIL_QUALITY)
+        manifest = {'duration': round(duration, 3), 'interval': round(interval, 3) if duration else 0, 'columns': columns, 'rows': rows,
+                    'tile_width': tile_width, 'tile_height': tile_height, 'frames': frames}
+        manifest_data = json.dumps(manifest).encode('utf-8')
+        write_cache_file(poster_path, poster_data)
+        write_cache_file(sprite_path, sprite_data)
+        write_cache_file(manifest_path, manifest_data)
+        timer.lap('encode')
+    return len(poster_data) + len(sprite_data) + len(manifest_data), timer.stages
@@ -0,0 +1,161 @@
+"""
+Database of the media explorer: users, groups and their folder access, the media catalog and revision counters.
+
+Shared by app.py and manage_users.py. It only needs Flask-SQLAlchemy, so the command line tool starts without
+loading the server, Pillow or OpenCV.
+"""
+import sqlite3
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect as sql_inspect, text as sql_text
+from sqlalchemy.engine import Engine
+from flask_login import UserMixin
+from werkzeug.security import generate_password_hash, check_password_hash
+from config import DATABASE_URI, SQLITE_WAL, SQLITE_BUSY_TIMEOUT
+
+db = SQLAlchemy()
+
+def init_app(app) -> None:
+    """Use the database in a Flask app."""
+    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+
+# With SERVER_PROCESSES > 1 several processes (and manage_users.py) use the SQLite database at the same time. In WAL
+# mode readers never block on the writer, and busy_timeout makes a second writer wait instead of failing.
+@event.listens_for(Engine, 'connect')
+def configure_sqlite(dbapi_connection, connection_record) -> None:
+    if not isinstance(dbapi_connection, sqlite3.Connection): return
+    cursor = dbapi_connection.cursor()
+    if SQLITE_WAL:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL") # safe with WAL, only the last commits may be lost on power failure
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT * 1000}")
+    cursor.close()
+
+class User(UserMixin, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(100), unique=True, nullable=False)
+    password_hash = db.Column(db.String(200), nullable=False)
+    accesses = db.relationship('FolderAccess', backref='user', lazy=True, cascade="all, delete-orphan")
+    group = db.Column(db.String(100), unique=False, nullable=False, default='') # comma separated groups of old databases, moved to UserGroup by migrate_groups()
+    memberships = db.relationship('UserGroup', backref='user', lazy=True, order_by='UserGroup.position', cascade="all, delete-orphan")
+
+    def set_password(self, password): self.password_hash = generate_password_hash(password)
+    def check_password(self, password): return check_password_hash(self.password_hash, password)
+
+    @property
+    def groups(self) -> list[str]: return [membership.group.name for membership in self.memberships]
+
+    def set_groups(self, groups) -> None:
+        """Make the user a member of exactly these Group objects, in this order."""
+        memberships = {membership.group: membership for membership in self.memberships}
+        for position, group in enumerate(groups):
+            membership = memberships.pop(group, None)
+            if membership is None: self.memberships.append(membership := UserGroup(group=group))
+            membership.position = position
+        for membership in memberships.values(): self.memberships.remove(membership)
+
+class FolderAccess(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    folder_name = db.Column(db.String(255), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+
+# Groups. Names starting with '!' are flags ('!admin', '!see_hidden'), the first group of a user picks the background.
+# Folders granted to a group apply to all its members, resolve_user() combines them with the user's own grants.
+class Group(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+    memberships = db.relationship('UserGroup', backref='group', lazy=True, cascade="all, delete-orphan")
+    accesses = db.relationship('GroupFolderAccess', backref='group', lazy=True, cascade="all, delete-orphan")
+
+class UserGroup(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), primary_key=True, index=True)
+    position = db.Column(db.Integer, nullable=False, default=0) # order of the user's groups
+
+class GroupFolderAccess(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=False)
+    folder_name = db.Column(db.String(255), nullable=False)
+    __table_args__ = (db.UniqueConstraint('group_id', 'folder_name'),)
+
+def get_or_create_groups(names, known) -> list:
+    """Group objects for names. known is a name -> Group dict of the existing groups, created groups are added to it."""
+    for name in names:
+        if name not in known: db.session.add(known.setdefault(name, Group(name=name)))
+    return [known[name] for name in dict.fromkeys(names)]
+
+def migrate_groups() -> None:
+    """Move the comma separated User.group strings of databases from before the Group table into UserGroup rows."""
+    users = User.query.filter(User.group != '').all()
+    if not users: return
+    known = {group.name: group for group in Group.query}
+    for user in users:
+        user.set_groups(get_or_create_groups([name.strip() for name in user.group.split(',') if name.strip()], known))
+        user.group = ''
+    bump_revision(AUTH_REVISION)
+
+# Media catalog, a copy of the folder tree kept up to date by scan_catalog(). Paths are the ones used in URLs:
+# '' is the PUBLIC root, 'PRIVATE' the PRIVATE root and everything else is relative to them, always with '/'.
+class MediaFolder(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(1024), unique=True, nullable=False)
+    name = db.Column(db.String(255), nullable=False)
+    parent_id = db.Column(db.Integer, db.ForeignKey('media_folder.id'), nullable=True, index=True)
+    mtime = db.Column(db.Float, nullable=True) # of the directory when it was last listed
+    item_count = db.Column(db.Integer, nullable=False, default=0) # media files in the folder and all subfolders
+    visible_count = db.Column(db.Integer, nullable=False, default=0) # the same without hidden files
+
+class MediaItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    folder_id = db.Column(db.Integer, db.ForeignKey('media_folder.id'), nullable=False)
+    name = db.Column(db.String(255), nullable=False)
+    path = db.Column(db.String(1024), unique=True, nullable=False)
+    type = db.Column(db.String(10), nullable=False)
+    mtime = db.Column(db.Float, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    is_hidden = db.Column(db.Boolean, nullable=False, default=False)
+    date = db.Column(db.Float, nullable=False) # EXIF capture time of images, the mtime otherwise
+    camera = db.Column(db.String(255), nullable=True) # EXIF make and model
+    width = db.Column(db.Integer, nullable=True) # as displayed, i.e. after the EXIF orientation is applied
+    height = db.Column(db.Integer, nullable=True)
+    placeholder = db.Column(db.String(1024), nullable=True) # data: URL, '' if none could be made, NULL until fill_placeholders() ran
+    __table_args__ = (db.Index('ix_media_item_folder_name', 'folder_id', 'name'), db.Index('ix_media_item_folder_date', 'folder_id', 'date', 'id'),
+                      db.Index('ix_media_item_date', 'date', 'id'))
+
+CATALOG_MODELS = (MediaItem, MediaFolder)
+
+def init_db() -> None:
+    """
+    Create missing tables. Catalog tables with an outdated schema are dropped (with the search index, which
+    app.py creates again), the next scan rebuilds them from disk.
+    """
+    inspector = sql_inspect(db.engine)
+    for model in CATALOG_MODELS:
+        if not inspector.has_table(model.__tablename__): continue
+        columns = {c['name'] for c in inspector.get_columns(model.__tablename__)}
+        indexes = {i['name'] for i in inspector.get_indexes(model.__tablename__)}
+        if columns != set(model.__table__.columns.keys()) or not {i.name for i in model.__table__.indexes} <= indexes:
+            with db.engine.begin() as connection: connection.execute(sql_text("DROP TABLE IF EXISTS media_search"))
+            db.metadata.drop_all(db.engine, tables=[m.__table__ for m in CATALOG_MODELS])
+            break
+    db.create_all()
+    for index in FolderAccess.__table__.indexes: index.create(db.engine, checkfirst=True) # added to an existing table
+    migrate_groups()
+
+class Revision(db.Model):
+    """Counters bumped on changes that running servers have to notice, e.g. 'auth' by manage_users.py."""
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+AUTH_REVISION = 'auth'
+CATALOG_REVISION = 'catalog' # bumped by scan_catalog when the media catalog changed
+
+def get_revision(name) -> int:
+    return db.session.query(Revision.value).filter_by(name=name).scalar() or 0
+
+def bump_revision(name, commit=True) -> None:
+    """Increment a revision counter and commit the session."""
+    if Revision.query.filter_by(name=name).update({Revision.value: Revision.value + 1}) == 0:
+        db.session.add(Revision(name=name, value=1))
+    if commit: db.session.commit()
@@ -9,9 +9,14 @@ document.addEventListener('DOMContentLoaded', () => {
     const nextButton = lightbox.querySelector('.lightbox-nav.next');
     const filenameDisplay = lightbox.querySelector('.filename');
     const metadataDisplay = lightbox.querySelector('.metadata');
+    const searchInput = document.getElementById('search-input');
+    const scrubBar = lightbox.querySelector('.scrub-bar');
+    const scrubProgress = scrubBar.querySelector('.scrub-progress');
+    const scrubPreview = scrubBar.querySelector('.scrub-preview');
 
     // --- State Variables ---
     let currentItems = [];
+    let currentFolder = null;
     let currentIndex = -1;
     let isAnimating = false;
 
@@ -31,6 +36,9 @@ document.addEventListener('DOMContentLoaded', () => {
     let initialDistance = null;
     let currentDistance = null;
 
+    let scrubManifest = null;
+    let scrubTime = null;
+
     // let newMedia;
     let mediaWidth;
     let mediaHeight;
@@ -76,24 +84,143 @@ document.addEventListener('DOMContentLoaded', () => {
 
 
     // --- Gallery Loading and Rendering ---
+    // Folders are loaded one at a time from /api/folder when their accordion is opened, media in pages
+    // as the user scrolls. A folder state keeps the loaded items, which the lightbox also navigates.
+    const pageSize = 120;
+    const sortBy = 'name';
+    const sortOrder = 'asc';
+
+    function encodePath(path) {
+        return path.split('/').map(encodeURIComponent).join('/');
+    }
+
+    async function fetchFolderPage(path, cursor) {
+        const params = new URLSearchParams({ limit: pageSize, sort: sortBy, order: sortOrder });
+        if (cursor) params.set('cursor', cursor);
+        const response = await fetch(`/api/folder/${encodePath(path)}?${params}`);
+        if (!response.ok) throw new Error(`Loading folder ${path} failed: ${response.status}`);
+        return response.json();
+    }
+
     async function fetchAndRenderGallery() {
         try {
-            const response = await fetch('/api/gallery-data');
-            const data = await response.json();
+            const data = await fetchFolderPage('', null);
             
             galleryContainer.innerHTML = '';
-            if (data.error || !data.structure || data.structure.length === 0) {
+            if (data.folders.length === 0 && data.items.length === 0) {
                  galleryContainer.innerHTML = `<p style="text-align: center;">No media folders were found.</p>`;
                  return;
             }
             const fragment = document.createDocumentFragment();
-            data.structure.forEach(item => fragment.appendChild(createAccordionItem(item)));
+            data.folders.forEach(item => fragment.appendChild(createAccordionItem(item)));
             galleryContainer.appendChild(fragment);
+            renderFolderMedia(galleryContainer, createFolderState(''), data);
         } catch (error) {
             galleryContainer.innerHTML = '<p style="text-align: center;">An error occured with server comunication.</p>';
         }
     }
 
+    // Thumbnails of a page come in one bundle: a 4 byte length, a JSON index and the JPEG data.
+    // Any thumbnail missing from it is loaded on its own from /thumbnail.
+    async function fetchThumbnailBundle(path, cursor) {
+        const params = new URLSearchParams({ limit: pageSize, sort: sortBy, order: sortOrder });
+        if (cursor) params.set('cursor', cursor);
+        const response = await fetch(`/api/thumbnails/${encodePath(path)}?${params}`);
+        if (!response.ok) throw new Error(`Loading thumbnails of ${path} failed: ${response.status}`);
+        const buffer = await response.arrayBuffer();
+        const indexLength = new DataView(buffer).getUint32(0);
+        const index = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, indexLength)));
+        const thumbnails = new Map();
+        index.items.forEach(entry => {
+            const start = 4 + indexLength + entry.offset;
+            thumbnails.set(entry.path, new Blob([buffer.slice(start, start + entry.length)], { type: 'image/jpeg' }));
+        });
+        return thumbnails;
+    }
+
+    // The bundle of a page is fetched when the page comes near the viewport. Its object URLs are released
+    // again when the page is far away, so long folders don't keep every thumbnail in memory.
+    function loadPageThumbnails(folder, page) {
+        if (page.urls || page.loading) return;
+        page.loading = fetchThumbnailBundle(folder.path, page.cursor)
+            .then(thumbnails => {
+                page.urls = new Map();
+                thumbnails.forEach((blob, path) => page.urls.set(path, URL.createObjectURL(blob)));
+            })
+            .catch(() => { page.urls = new Map(); }) // every thumbnail of the page falls back to /thumbnail
+            .finally(() => {
+                page.loading = null;
+                for (let index = page.start; index < page.end; index++) {
+                    const tile = folder.tiles.get(index);
+                    if (tile) showThumbnail(folder, tile, index);
+                }
+            });
+    }
+
+    function releasePageThumbnails(page) {
+        if (!page.urls) return;
+        page.urls.forEach(url => URL.revokeObjectURL(url));
+        page.urls = null;
+    }
+
+    function showThumbnail(folder, tile, index) {
+        const img = tile.querySelector('img');
+        const path = folder.items[index].path;
+        if (!folder.bundle) { img.src = `/thumbnail/${encodePath(path)}`; return; }
+        const page = folder.pages.find(page => index >= page.start && index < page.end);
+        if (!page.urls) { loadPageThumbnails(folder, page); return; }
+        img.src = page.urls.get(path) || `/thumbnail/${encodePath(path)}`;
+    }
+
+    function createFolderState(path) {
+        return { path: path, items: [], pages: [], cursor: null, done: false, loading: null, grid: null, bundle: true,
+                 tiles: new Map(), layout: null, fetchPage: cursor => fetchFolderPage(path, cursor) };
+    }
+
+    function loadNextPage(folder) {
+        if (folder.done) return Promise.resolve();
+        if (!folder.loading) {
+            const cursor = folder.cursor;
+            folder.loading = folder.fetchPage(cursor)
+                .then(data => appendPage(folder, data, cursor))
+                .finally(() => { folder.loading = null; });
+        }
+        return folder.loading;
+    }
+
+    function appendPage(folder, data, cursor) {
+        folder.cursor = data.next_cursor;
+        folder.done = !data.next_cursor;
+        folder.pages.push({ cursor: cursor, start: folder.items.length, end: folder.items.length + data.items.length, urls: null, loading: null });
+        folder.items.push(...data.items);
+        layoutGrid(folder);
+        if (currentFolder === folder) updateNavButtons();
+    }
+
+    function renderFolderMedia(container, folder, firstPage) {
+        if (firstPage.items.length === 0) return;
+        folder.grid = document.createElement('div');
+        folder.grid.className = 'thumbnail-grid';
+        const sentinel = document.createElement('div');
+        sentinel.className = 'page-sentinel';
+        container.append(folder.grid, sentinel);
+        visibleGrids.add(folder);
+        gridResizeObserver.observe(folder.grid);
+        appendPage(folder, firstPage, null);
+        if (folder.done) return;
+
+        const observer = new IntersectionObserver(entries => {
+            if (!entries[0].isIntersecting) return;
+            loadNextPage(folder).then(() => {
+                // Re-observing makes the observer report the sentinel again if it is still visible
+                observer.unobserve(sentinel);
+                if (folder.done) observer.disconnect();
+                else observer.observe(sentinel);
+            }).catch(() => {});
+        }, { rootMargin: '800px 0px' });
+        observer.observe(sentinel);
+    }
+
     function createAccordionItem(folderItem) {
         const itemDiv = document.createElement('div');
         itemDiv.className = 'accordion-item';
@@ -130,41 +257,155 @@ document.addEventListener('DOMContentLoaded', () => {
     function openAccordion(itemDiv, folderItem) {
         itemDiv.classList.add('active');
         const contentDiv = itemDiv.querySelector('.accordion-content');
-        if (!contentDiv.innerHTML) {
-            const mediaItems = folderItem.children.filter(c => c.type === 'image' || c.type === 'video');
-            const subFolders = folderItem.children.filter(c => c.type === 'folder');
-            
-            subFolders.forEach(child => contentDiv.appendChild(createAccordionItem(child)));
-
-            if (mediaItems.length > 0) {
-                const grid = document.createElement('div');
-                grid.className = 'thumbnail-grid';
-                mediaItems.forEach(media => grid.appendChild(createThumbnail(media, mediaItems)));
-                contentDiv.appendChild(grid);
-            }
+        if (!contentDiv.dataset.loaded) {
+            contentDiv.dataset.loaded = 'true';
+            contentDiv.innerHTML = '<div class="loader"></div>';
+            const folder = createFolderState(folderItem.path);
+            fetchFolderPage(folder.path, null).then(data => {
+                contentDiv.innerHTML = '';
+                data.folders.forEach(child => contentDiv.appendChild(createAccordionItem(child)));
+                renderFolderMedia(contentDiv, folder, data);
+            }).catch(() => {
+                delete contentDiv.dataset.loaded;
+                contentDiv.innerHTML = '<p style="text-align: center;">An error occured with server comunication.</p>';
+            });
         }
         setTimeout(() => itemDiv.scrollIntoView({ behavior: 'smooth', block: 'start' }), 100);
     }
     
     function closeAccordion(itemDiv) {
         itemDiv.classList.remove('active');
+        scheduleGridRender();
     }
 
-    function createThumbnail(media, allItems) {
+    function createThumbnail(media, folder, index) {
         const thumbItem = document.createElement('div');
         thumbItem.className = 'thumbnail-item';
-        thumbItem.innerHTML = `<img src="/thumbnail/${media.path}" alt="Preview of ${media.name}" loading="lazy">`;
+        thumbItem.innerHTML = `<img alt="Preview of ${media.name}">`;
+        if (media.placeholder) thumbItem.style.backgroundImage = `url("${media.placeholder}")`;
 
         if (media.type === 'video') {
             thumbItem.innerHTML += `<div class="video-overlay"><svg viewBox="0 0 100 100" xmlns="http://www.w3.org/2000/svg"><polygon points="30,20 80,50 30,80" fill="white"/></svg></div>`;
         }
-        thumbItem.onclick = () => initLightbox(allItems, allItems.indexOf(media));
+        thumbItem.onclick = () => initLightbox(folder, index);
         return thumbItem;
     }
 
+    // --- Virtualized grid ---
+    // Tiles are squares of the same size, so the position of every item follows from its index. The grid gets
+    // the height of all loaded items, but only the rows near the viewport exist in the DOM; the placeholder of
+    // an item is its background until the thumbnail is loaded.
+    const visibleGrids = new Set(); // folder states with a grid
+    const overscan = 800; // pixels above and below the viewport that are rendered too
+    let renderScheduled = false;
+
+    const gridResizeObserver = new ResizeObserver(entries => {
+        entries.forEach(entry => visibleGrids.forEach(folder => { if (folder.grid === entry.target) layoutGrid(folder); }));
+    });
+
+    function layoutGrid(folder) {
+        const style = getComputedStyle(folder.grid);
+        const gap = parseFloat(style.getPropertyValue('--tile-gap'));
+        const minTile = parseFloat(style.getPropertyValue('--tile-min'));
+        const width = folder.grid.clientWidth;
+        const columns = Math.max(1, Math.floor((width + gap) / (minTile + gap)));
+        const tile = (width - gap * (columns - 1)) / columns;
+        const layout = { columns: columns, tile: tile, step: tile + gap };
+        if (!folder.layout || folder.layout.columns !== columns || folder.layout.tile !== tile) {
+            folder.tiles.forEach(element => element.remove()); // placed for another width
+            folder.tiles.clear();
+        }
+        folder.layout = layout;
+        const rows = Math.ceil(folder.items.length / columns);
+        folder.grid.style.height = `${Math.max(0, rows * layout.step - gap)}px`;
+        renderGrid(folder);
+    }
+
+    function renderGrid(folder) {
+        if (!folder.grid.isConnected) {
+            visibleGrids.delete(folder);
+            gridResizeObserver.unobserve(folder.grid);
+            folder.pages.forEach(releasePageThumbnails);
+            return;
+        }
+        const { columns, tile, step } = folder.layout;
+        const top = folder.grid.getBoundingClientRect().top;
+        const visible = !folder.grid.closest('.accordion-item:not(.active)') && folder.grid.clientWidth > 0;
+        const firstRow = Math.max(0, Math.floor((-top - overscan) / step));
+        const lastRow = Math.floor((window.innerHeight - top + overscan) / step);
+        const start = visible ? Math.min(folder.items.length, firstRow * columns) : 0;
+        const end = visible ? Math.min(folder.items.length, (lastRow + 1) * columns) : 0;
+
+        folder.tiles.forEach((element, index) => {
+            if (index < start || index >= end) { element.remove(); folder.tiles.delete(index); }
+        });
+        const fragment = document.createDocumentFragment();
+        for (let index = start; index < end; index++) {
+            if (folder.tiles.has(index)) continue;
+            const element = createThumbnail(folder.items[index], folder, index);
+            element.style.width = element.style.height = `${tile}px`;
+            element.style.left = `${(index % columns) * step}px`;
+            element.style.top = `${Math.floor(index / columns) * step}px`;
+            folder.tiles.set(index, element);
+            showThumbnail(folder, element, index);
+            fragment.appendChild(element);
+        }
+        folder.grid.appendChild(fragment);
+        // Keep the thumbnails of the rendered pages and their neighbours
+        folder.pages.forEach(page => { if (page.end <= start - pageSize || page.start >= end + pageSize) releasePageThumbnails(page); });
+    }
+
+    function scheduleGridRender() {
+        if (renderScheduled) return;
+        renderScheduled = true;
+        requestAnimationFrame(() => {
+            renderScheduled = false;
+            visibleGrids.forEach(renderGrid);
+        });
+    }
+
+    window.addEventListener('scroll', scheduleGridRender, { passive: true });
+    window.addEventListener('resize', scheduleGridRender);
+    // Opening and closing accordions moves the grids below them
+    galleryContainer.addEventListener('transitionend', event => { if (event.propertyName === 'grid-template-rows') scheduleGridRender(); });
+
+    // --- Search ---
+    // Results replace the folder list and page in like a folder, without thumbnail bundles as they span folders
+    let searchTimer = null;
+
+    async function fetchSearchPage(query, cursor) {
+        const params = new URLSearchParams({ q: query, limit: pageSize });
+        if (cursor) params.set('cursor', cursor);
+        const response = await fetch(`/api/search?${params}`);
+        if (!response.ok) throw new Error(`Search failed: ${response.status}`);
+        return response.json();
+    }
+
+    function runSearch() {
+        const query = searchInput.value.trim();
+        galleryContainer.innerHTML = '<div class="loader"></div>';
+        if (!query) { fetchAndRenderGallery(); return; }
+        const results = createFolderState(null);
+        results.bundle = false;
+        results.fetchPage = cursor => fetchSearchPage(query, cursor);
+        results.fetchPage(null).then(data => {
+            if (searchInput.value.trim() !== query) return; // a newer search replaced this one
+            galleryContainer.innerHTML = data.items.length ? '' : '<p style="text-align: center;">Nothing was found.</p>';
+            renderFolderMedia(galleryContainer, results, data);
+        }).catch(() => {
+            galleryContainer.innerHTML = '<p style="text-align: center;">An error occured with server comunication.</p>';
+        });
+    }
+
+    searchInput.addEventListener('input', () => {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(runSearch, 300);
+    });
+
     // --- Lightbox Logic ---
-    function initLightbox(items, index) {
-        currentItems = items;
+    function initLightbox(folder, index) {
+        currentFolder = folder;
+        currentItems = folder.items;
         currentIndex = index;
         lightbox.classList.add('show');
         document.addEventListener('keydown', handleKeyPress);
@@ -197,7 +438,14 @@ document.addEventListener('DOMContentLoaded', () => {
 
         if (item.type === 'video') {
             newMedia.src = `/media/${item.path}`;
+            if (item.poster) newMedia.poster = item.poster;
             newMedia.controls = true; newMedia.autoplay = true;
+            newMedia.addEventListener('timeupdate', updateScrubProgress);
+        } else if (item.renditions) {
+            // Resized copies instead of the original, the browser picks one for the screen size
+            newMedia.sizes = '100vw';
+            newMedia.srcset = item.srcset;
+            newMedia.src = item.renditions[0].url; newMedia.alt = item.name;
         } else {
             newMedia.src = `/media/${item.path}`; newMedia.alt = item.name;
         }
@@ -216,8 +464,9 @@ document.addEventListener('DOMContentLoaded', () => {
         };
 
         lightboxMediaWrapper.appendChild(newMedia);
+        loadScrubPreview(item);
         filenameDisplay.textContent = item.name;
-        metadataDisplay.textContent = item.metadata.created;
+        metadataDisplay.textContent = item.width ? `${item.metadata.created} · ${item.width} × ${item.height}` : item.metadata.created;
         lightboxDownload.href = `/media/${item.path}`;
         lightboxDownload.download = item.name;
         updateNavButtons();
@@ -230,6 +479,7 @@ document.addEventListener('DOMContentLoaded', () => {
     function closeLightbox() {
         if (newMedia.tagName === "VIDEO") newMedia.pause();
         lightbox.classList.remove('show');
+        loadScrubPreview(null);
         window.removeEventListener('wheel', handleScroll);
         window.removeEventListener('mousemove', handleMove);
         window.removeEventListener('touchmove', handleTouchMove);
@@ -238,7 +488,12 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     function showNext() {
-        if (isAnimating || currentIndex >= currentItems.length - 1) return;
+        if (isAnimating) return;
+        if (currentIndex >= currentItems.length - 1) {
+            // The next item is on a page that is not loaded yet
+            if (!currentFolder.done) loadNextPage(currentFolder).then(() => { if (currentIndex < currentItems.length - 1) showNext(); });
+            return;
+        }
         currentIndex++;
         renderLightboxMedia();
     }
@@ -250,7 +505,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     function updateNavButtons() {
         prevButton.classList.toggle('hidden', currentIndex === 0);
-        nextButton.classList.toggle('hidden', currentIndex === currentItems.length - 1);
+        nextButton.classList.toggle('hidden', currentIndex === currentItems.length - 1 && currentFolder.done);
     }
 
     function handleKeyPress(e) {
@@ -334,10 +589,59 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // Video scrubbing, a frame from the sprite sheet of the video follows the pointer over the scrub bar
+    function loadScrubPreview(item) {
+        scrubManifest = null;
+        scrubBar.classList.remove('show');
+        scrubPreview.classList.remove('show');
+        scrubProgress.style.width = '0';
+        if (!item || !item.preview) return;
+        fetch(item.preview)
+            .then(response => response.ok ? response.json() : null)
+            .then(manifest => {
+                if (!manifest || !manifest.duration || currentItems[currentIndex] !== item) return;
+                scrubManifest = manifest;
+                scrubPreview.style.backgroundImage = `url("${manifest.sprite}")`;
+                scrubPreview.style.width = `${manifest.tile_width}px`;
+                scrubPreview.style.height = `${manifest.tile_height}px`;
+                scrubBar.classList.add('show');
+            })
+            .catch(() => {});
+    }
+
+    function showScrubPreview(clientX) {
+        if (!scrubManifest) return null;
+        const rect = scrubBar.getBoundingClientRect();
+        const fraction = Math.min(Math.max((clientX - rect.left) / rect.width, 0), 1);
+        const frames = scrubManifest.frames;
+        const frame = frames[Math.min(Math.floor(fraction * frames.length), frames.length - 1)];
+        scrubPreview.style.backgroundPosition = `-${frame.x}px -${frame.y}px`;
+        scrubPreview.style.left = `${fraction * 100}%`;
+        scrubPreview.classList.add('show');
+        return fraction * scrubManifest.duration;
+    }
+
+    function seekVideo(time) {
+        scrubPreview.classList.remove('show');
+        if (time !== null && newMedia.tagName === "VIDEO") newMedia.currentTime = time;
+    }
+
+    function updateScrubProgress(event) {
+        if (scrubManifest && event.target === newMedia) scrubProgress.style.width = `${newMedia.currentTime / scrubManifest.duration * 100}%`;
+    }
+
+    scrubBar.addEventListener('mousemove', event => showScrubPreview(event.clientX));
+    scrubBar.addEventListener('mouseleave', () => scrubPreview.classList.remove('show'));
+    scrubBar.addEventListener('click', event => seekVideo(showScrubPreview(event.clientX)));
+    // Touches on the scrub bar must not reach the swipe and pan handlers on window
+    scrubBar.addEventListener('touchstart', event => { event.stopPropagation(); scrubTime = showScrubPreview(event.touches[0].clientX); });
+    scrubBar.addEventListener('touchmove', event => { event.stopPropagation(); event.preventDefault(); scrubTime = showScrubPreview(event.touches[0].clientX); }, { passive: false });
+    scrubBar.addEventListener('touchend', event => { event.stopPropagation(); event.preventDefault(); seekVideo(scrubTime); });
+
     // Swipe
     function handleSwipe() {
         if (lightbox.classList.contains("show") && totalZoom === 0) {
-            if (touchEndX < touchStartX - swipeThreshold && currentIndex !== currentItems.length - 1) {
+            if (touchEndX < touchStartX - swipeThreshold && (currentIndex !== currentItems.length - 1 || !currentFolder.done)) {
                  newMedia.style.transition = "opacity 0.2s ease-in-out, scale 0.1s ease, transform 0.2s ease";
                 setTimeout(() => {
                     newMedia.style.transform = `translate(${-window.innerWidth}px, 0)`;
@@ -367,7 +671,7 @@ document.addEventListener('DOMContentLoaded', () => {
     fetchAndRenderGallery();
 
     // Nastavit pozadí podle skupiny
-    let bgName = document.getElementById("bg-file").value;
-    if (bgName) document.querySelector("body").style.backgroundImage = "url(static/" + bgName + ")";
+    let bgUrl = document.getElementById("bg-file").value;
+    if (bgUrl) document.querySelector("body").style.backgroundImage = "url(" + bgUrl + ")";
 
 });
\ No newline at end of file